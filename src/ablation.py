@@ -1,11 +1,14 @@
 import argparse, os, json, yaml, pandas as pd, numpy as np
+import pyarrow.parquet as pq
 from sklearn.metrics import roc_auc_score, average_precision_score, brier_score_loss
 from joblib import dump
 from .train import load_splits, infer_feature_types, load_config
 from .models import make_logreg, make_xgb, make_catboost
+from .dataset_cache import QuantizedCache
 
 def select_columns(df, groups, keep_groups=None, drop_groups=None):
-    cols = df.columns.tolist()
+    # df: a DataFrame or just its column names
+    cols = df.columns.tolist() if hasattr(df, "columns") else list(df)
     if keep_groups:
         keep = set()
         for g in keep_groups:
@@ -27,6 +30,9 @@ def main():
     ap.add_argument("--ablation", type=str, required=True, help="ablation config path")
     ap.add_argument("--seeds", type=int, nargs="+", default=[42,43,44])
     ap.add_argument("--model", type=str, default="xgb", choices=["logreg","xgb","cat"])
+    ap.add_argument("--quantize", action="store_true",
+                    help="fit the preprocessor and quantize each experiment's train split once, reused across seeds")
+    ap.add_argument("--quantized_dir", type=str, default=None, help="persist quantized CatBoost pools here")
     args = ap.parse_args()
 
     cfg = load_config(args.cfg)
@@ -35,25 +41,29 @@ def main():
     groups = ablcfg["feature_groups"]
 
     dcfg, mcfg = cfg["data"], cfg["models"]
-    Xtr_full, ytr = load_splits(dcfg["processed_dir"], dcfg["train_months"], dcfg["label_col"])
-    Xva_full, yva = load_splits(dcfg["processed_dir"], dcfg["valid_months"], dcfg["label_col"])
+    native = cfg.get("training", {}).get("tree_native", False)
+    categorical = cfg.get("features", {}).get("categorical") or ()
+    # only the schema up front; each experiment reads just the columns it uses
+    schema = pq.read_schema(os.path.join(dcfg["processed_dir"], f"table_{dcfg['train_months'][0]}.parquet"))
+    all_cols = [c for c in schema.names if c != dcfg["label_col"]]
 
+    qcache = QuantizedCache(args.quantized_dir) if args.quantize else None
     results = []
     for exp in ablcfg["experiments"]:
         keep_groups = exp.get("keep_groups")
         drop_groups = exp.get("drop_groups")
 
-        tr_cols = select_columns(Xtr_full, groups, keep_groups, drop_groups)
-        va_cols = [c for c in tr_cols if c in Xva_full.columns]
-
-        Xtr = Xtr_full[tr_cols]
-        Xva = Xva_full[va_cols]
+        tr_cols = select_columns(all_cols, groups, keep_groups, drop_groups)
+        Xtr, ytr = load_splits(dcfg["processed_dir"], dcfg["train_months"], dcfg["label_col"],
+                               columns=tr_cols, filters=dcfg.get("filters"), cache_dir=dcfg.get("feature_cache_dir"))
+        Xva, yva = load_splits(dcfg["processed_dir"], dcfg["valid_months"], dcfg["label_col"],
+                               columns=tr_cols, filters=dcfg.get("filters"), cache_dir=dcfg.get("feature_cache_dir"))
 
         # infer numeric/categorical
         num_cols, cat_cols = [], []
         for c in tr_cols:
             if c in [dcfg["label_col"], dcfg["time_col"]]: continue
-            if str(Xtr[c].dtype).startswith(("float","int")):
+            if str(Xtr[c].dtype).lower().startswith(("float","int","uint")) and c not in categorical:
                 num_cols.append(c)
             else:
                 cat_cols.append(c)
@@ -61,17 +71,24 @@ def main():
         if args.model == "logreg":
             factory = lambda: make_logreg(num_cols, cat_cols, C=cfg["models"]["logistic_regression"]["C"], max_iter=cfg["models"]["logistic_regression"]["max_iter"])
         elif args.model == "xgb":
-            factory = lambda: make_xgb(num_cols, cat_cols, mcfg["xgboost"])
+            factory = lambda: make_xgb(num_cols, cat_cols, mcfg["xgboost"], native=native)
         else:
-            factory = lambda: make_catboost(num_cols, cat_cols, mcfg["catboost"])
+            factory = lambda: make_catboost(num_cols, cat_cols, mcfg["catboost"], native=native)
+
+        if qcache:
+            pre = factory()[:-1].fit(Xtr, ytr)
+            Ztr, Zva = pre.transform(Xtr), pre.transform(Xva)
 
         seed_metrics = []
         for seed in args.seeds:
             mdl = factory()
             if hasattr(mdl[-1], "random_state"):
                 mdl[-1].set_params(random_state=seed)
-            mdl.fit(Xtr, ytr)
-            p_va = mdl.predict_proba(Xva)[:,1]
+            if qcache:
+                p_va = qcache.fit(mdl[-1], exp["name"], Ztr, ytr).predict_proba(Zva)[:,1]
+            else:
+                mdl.fit(Xtr, ytr)
+                p_va = mdl.predict_proba(Xva)[:,1]
             m = {
                 "roc_auc": float(roc_auc_score(yva, p_va)),
                 "pr_auc": float(average_precision_score(yva, p_va)),
@@ -0,0 +1,109 @@
+import numpy as np
+from .cost_sweep import cost
+from .scheduler import run_parallel
+
+# Bootstrap CIs from pre-binned counts. Rows are grouped into cells (score bin x
+# label); a resample only changes how many rows land in each cell, so one replicate
+# is one multinomial (or Poisson) draw of cell counts and every metric follows from
+# cumulative sums over the bins: O(cells) per replicate instead of O(rows), drawn in
+# blocks as one (replicates x bins) array. Scores inside a bin count as tied for
+# ROC/PR-AUC and sit at the cell mean for Brier/ECE, so the error is bounded by the
+# bin width; cost thresholds and ECE bin edges are bin edges, so those counts are exact.
+
+METRICS = ("roc_auc", "pr_auc", "brier", "ece", "expected_cost")
+BLOCK = 64        # replicates per draw; fixed so results do not depend on jobs
+
+def roc_auc_counts(pos, neg):
+    # ROC-AUC from positive/negative counts per ascending score bin (last axis);
+    # rows in one bin count as tied
+    below = np.cumsum(neg, -1) - neg
+    return (pos * (below + 0.5 * neg)).sum(-1) / (pos.sum(-1) * neg.sum(-1))
+
+def pr_auc_counts(pos, neg):
+    # average precision (step-wise, as sklearn) from the same counts
+    tp, fp = np.cumsum(pos[..., ::-1], -1), np.cumsum(neg[..., ::-1], -1)
+    prec = np.where(tp + fp > 0, tp / np.maximum(tp + fp, 1), 0.0)
+    return (prec * pos[..., ::-1]).sum(-1) / pos.sum(-1)
+
+def bin_edges(resolution, extra=()):
+    # uniform edges on [0, 1] plus extra cut points (thresholds, ECE edges)
+    return np.unique(np.r_[np.linspace(0.0, 1.0, resolution + 1), np.asarray(extra, dtype=np.float64)])
+
+def bin_index(edges, p):
+    return np.clip(np.searchsorted(edges, p, side="right") - 1, 0, None)   # edges[b] <= p < edges[b+1]
+
+class Binned:
+    def __init__(self, y, p, thresholds=(), n_bins=15, resolution=10000):
+        p = np.asarray(p, dtype=np.float64)
+        y = np.asarray(y).astype(bool)
+        edges = bin_edges(resolution, np.r_[np.linspace(0.0, 1.0, n_bins + 1), thresholds])
+        b = bin_index(edges, p)
+        k = len(edges)
+        pos = np.bincount(b[y], minlength=k).astype(np.float64)
+        neg = np.bincount(b[~y], minlength=k).astype(np.float64)
+        keep = (pos + neg) > 0
+        self.lo = edges[:k][keep]                         # left edge of each non-empty bin
+        self.pos, self.neg = pos[keep], neg[keep]
+        # per-cell mean score and squared score
+        def mean(w, lab, cnt):
+            s = np.bincount(b[lab], weights=w[lab], minlength=k)[keep]
+            return np.divide(s, cnt, out=np.zeros_like(s), where=cnt > 0)
+        self.mp_pos, self.mq_pos = mean(p, y, self.pos), mean(p * p, y, self.pos)
+        self.mp_neg, self.mq_neg = mean(p, ~y, self.neg), mean(p * p, ~y, self.neg)
+        # ECE bin of each cell (np.digitize convention; p == 1.0 falls outside, as in ece_score)
+        ece_bin = np.digitize(self.lo, np.linspace(0.0, 1.0, n_bins + 1)) - 1
+        self.ece_onehot = (ece_bin[:, None] == np.arange(n_bins)).astype(np.float64)   # (cells, n_bins)
+
+    def metrics(self, pos, neg, threshold=None, ccfg=None, which=METRICS) -> dict:
+        # pos, neg: (replicates, cells) counts -> {metric: (replicates,)}
+        P, N = pos.sum(1), neg.sum(1)
+        n = P + N
+        out = {}
+        with np.errstate(invalid="ignore", divide="ignore"):
+            if "roc_auc" in which:
+                out["roc_auc"] = roc_auc_counts(pos, neg)
+            if "pr_auc" in which:
+                out["pr_auc"] = pr_auc_counts(pos, neg)
+            if "brier" in which:
+                out["brier"] = ((pos * (1 - 2 * self.mp_pos + self.mq_pos)).sum(1) + (neg * self.mq_neg).sum(1)) / n
+            if "ece" in which:
+                # |positives - summed scores| per ECE bin, weighted by its share of rows
+                gap = pos - (pos * self.mp_pos + neg * self.mp_neg)
+                out["ece"] = np.abs(gap @ self.ece_onehot).sum(1) / n
+            if "expected_cost" in which and threshold is not None:
+                hit = self.lo >= threshold
+                tp, fp = pos[:, hit].sum(1), neg[:, hit].sum(1)
+                out["expected_cost"] = cost(tp, fp, P - tp, N - fp, ccfg)
+        return out
+
+def draw_counts(rng, cells, n, method="multinomial"):
+    # n bootstrap replicates of per-cell row counts -> (n, cells) float64
+    if method == "poisson":
+        return rng.poisson(cells, size=(n, len(cells))).astype(np.float64)
+    return rng.multinomial(int(cells.sum()), cells / cells.sum(), size=n).astype(np.float64)
+
+def _replicates(binned: Binned, seed_seq, n, method, threshold, ccfg, which, stratified=False):
+    rng = np.random.default_rng(seed_seq)
+    if stratified:
+        # positives and negatives resampled separately (label counts fixed by the design)
+        return binned.metrics(draw_counts(rng, binned.pos, n, method), draw_counts(rng, binned.neg, n, method),
+                              threshold, ccfg, which)
+    draws = draw_counts(rng, np.r_[binned.pos, binned.neg], n, method)
+    k = len(binned.pos)
+    return binned.metrics(draws[:, :k], draws[:, k:], threshold, ccfg, which)
+
+def bootstrap(y, p, n_boot=1000, seed=0, jobs=1, method="multinomial", threshold=None, ccfg=None,
+              n_bins=15, resolution=10000, which=METRICS, stratified=False) -> dict:
+    # -> {metric: (n_boot,) replicate values}; reproducible for a seed whatever jobs is.
+    # method: "multinomial" (classic resampling of n rows) or "poisson" (Poisson(1) row weights);
+    # stratified: resample within each label
+    binned = Binned(y, p, () if threshold is None else [threshold], n_bins, resolution)
+    sizes = [min(BLOCK, n_boot - i) for i in range(0, n_boot, BLOCK)]
+    seqs = np.random.SeedSequence(seed).spawn(len(sizes))
+    tasks = [(binned, s, n, method, threshold, ccfg, which, stratified) for s, n in zip(seqs, sizes)]
+    parts = run_parallel(_replicates, tasks, jobs=jobs)
+    return {k: np.concatenate([r[k] for r in parts]) for k in parts[0]}
+
+def percentile_ci(reps: dict, alpha=0.05) -> dict:
+    # {metric: replicates} -> {metric: [lo, hi]}
+    return {k: [float(v) for v in np.nanquantile(r, [alpha / 2, 1 - alpha / 2])] for k, r in reps.items()}
@@ -1,32 +1,16 @@
 import argparse, os, json, numpy as np, pandas as pd, yaml
 from joblib import load
 from sklearn.calibration import calibration_curve
-from sklearn.utils import resample
+from .bootstrap import bootstrap, percentile_ci
 
 def ece_score(y_true, y_prob, n_bins=15):
-    bins = np.linspace(0.0, 1.0, n_bins+1)
-    inds = np.digitize(y_prob, bins) - 1
-    ece = 0.0
-    for b in range(n_bins):
-        mask = inds==b
-        if not np.any(mask):
-            continue
-        conf = y_prob[mask].mean()
-        acc = y_true[mask].mean()
-        w = mask.mean()
-        ece += np.abs(acc - conf) * w
-    return float(ece)
-
-def bootstrap_ci(y, p, func, n_boot=200, alpha=0.05, **kwargs):
-    vals = []
-    n = len(y)
-    for _ in range(n_boot):
-        idx = np.random.randint(0, n, n)
-        vals.append(func(y[idx], p[idx], **kwargs))
-    vals = np.sort(vals)
-    lo = vals[int((alpha/2)*n_boot)]
-    hi = vals[int((1-alpha/2)*n_boot)-1]
-    return float(lo), float(hi)
+    # one pass of bincounts; scores outside [0, 1) (e.g. exactly 1.0) are left out of every bin
+    inds = np.digitize(y_prob, np.linspace(0.0, 1.0, n_bins+1)) - 1
+    ok = (inds >= 0) & (inds < n_bins)
+    i = inds[ok]
+    cnt = np.bincount(i, minlength=n_bins)
+    gap = np.bincount(i, weights=y_true[ok], minlength=n_bins) - np.bincount(i, weights=y_prob[ok], minlength=n_bins)
+    return float(np.abs(gap[cnt > 0]).sum() / len(y_prob))
 
 def main():
     ap = argparse.ArgumentParser()
@@ -35,6 +19,12 @@ def main():
     ap.add_argument("--model", type=str, default="xgb", choices=["logreg","xgb","cat"])
     ap.add_argument("--n_bins", type=int, default=15)
     ap.add_argument("--n_boot", type=int, default=200)
+    ap.add_argument("--boot_seed", type=int, default=0, help="bootstrap seed; CIs are reproducible for a seed")
+    ap.add_argument("--jobs", type=int, default=1, help="processes for bootstrap replicates")
+    ap.add_argument("--quick", action="store_true",
+                    help="score a (month, label)-stratified sample grown until the ECE CI is within --precision")
+    ap.add_argument("--precision", type=float, default=0.001, help="target 95%% CI half-width of ECE with --quick")
+    ap.add_argument("--quick_start", type=int, default=20000, help="first sample size with --quick")
     args = ap.parse_args()
 
     with open(args.cfg,"r") as f:
@@ -43,17 +33,48 @@ def main():
 
     # load test set & model
     from .evaluate import load_splits
-    Xte, yte = load_splits(dcfg["processed_dir"], dcfg["test_months"], dcfg["label_col"])
+    from .prediction_store import store_from_config
     model_path = f"models/seed_{args.seed}/{args.model}.joblib"
-    mdl = load(model_path)
-    prob = mdl.predict_proba(Xte)[:,1]
+    store = store_from_config(dcfg)
+    quick = None
+    if args.quick:
+        from .quick_eval import sequential_sample, TestRows
+        rows = TestRows(dcfg["processed_dir"], dcfg["test_months"], dcfg["label_col"], cache_dir=dcfg.get("feature_cache_dir"))
+        mdl = load(model_path)
+        idx, preds, hw, rounds = sequential_sample(rows.strata, rows.y,
+                                                   lambda i: {args.model: mdl.predict_proba(rows.features(i))[:,1]},
+                                                   args.precision, ("ece",), args.quick_start, n_boot=args.n_boot,
+                                                   seed=args.boot_seed, jobs=args.jobs, n_bins=args.n_bins)
+        prob, yte = preds[args.model], rows.y[idx]
+        quick = {"n_sampled": len(idx), "n_total": len(rows.y), "rounds": rounds, "ece_half_width": hw[args.model]["ece"]}
+    elif store:
+        sc = store.scores(model_path, args.seed, dcfg["test_months"])
+        prob, yte = sc["score"].to_numpy(), sc["label"].to_numpy().astype(int)
+    elif dcfg.get("feature_cache_dir"):
+        Xte, yte = load_splits(dcfg["processed_dir"], dcfg["test_months"], dcfg["label_col"],
+                               cache_dir=dcfg.get("feature_cache_dir"))
+        mdl = load(model_path)
+        from .feature_cache import FeatureCache
+        cache = FeatureCache(dcfg["feature_cache_dir"], dcfg["processed_dir"], dcfg["label_col"])
+        prob = cache.predict_proba(mdl, dcfg["test_months"])
+    else:
+        Xte, yte = load_splits(dcfg["processed_dir"], dcfg["test_months"], dcfg["label_col"])
+        mdl = load(model_path)
+        prob = mdl.predict_proba(Xte)[:,1]
 
     # reliability diagram data
     frac_pos, mean_pred = calibration_curve(yte, prob, n_bins=args.n_bins, strategy="uniform")
 
     # ECE + CI
     ece = ece_score(yte, prob, n_bins=args.n_bins)
-    lo, hi = bootstrap_ci(yte, prob, lambda y,p: ece_score(y,p,n_bins=args.n_bins), n_boot=args.n_boot)
+    if quick:
+        # the sample's design: label-stratified, finite-population corrected (as the stopping rule)
+        from .quick_eval import fpc_ci
+        lo, hi = fpc_ci(yte, prob, ("ece",), quick["n_total"], args.n_boot, args.boot_seed, args.jobs, args.n_bins)["ece"]
+    else:
+        reps = bootstrap(yte, prob, n_boot=args.n_boot, seed=args.boot_seed, jobs=args.jobs, n_bins=args.n_bins,
+                         which=("ece",))
+        lo, hi = percentile_ci(reps)["ece"]
 
     os.makedirs("reports/calibration", exist_ok=True)
     out = {
@@ -63,6 +84,8 @@ def main():
         "ece": ece,
         "ece_ci": [lo, hi]
     }
+    if quick:
+        out["quick"] = quick
     with open("reports/calibration/calibration_seed{}_{}.json".format(args.seed, args.model), "w") as f:
         json.dump(out, f, indent=2)
     print(json.dumps(out, indent=2))
@@ -0,0 +1,61 @@
+import numpy as np
+
+# Confusion counts at every threshold from one sort of the scores: rows are
+# ordered by descending score and positives/negatives are cumulated, so the
+# counts for "predict 1 if p >= t" at all distinct scores and at any grid of t
+# cost O(n log n) in total instead of O(n) per threshold. w: optional row weights.
+
+class Sweep:
+    def __init__(self, y, p, w=None):
+        p = np.asarray(p)
+        order = np.argsort(p)[::-1]                      # descending; ties are grouped below
+        self.ps = p[order].astype(np.float64, copy=False)   # thresholds compare as in float64
+        y = np.asarray(y)[order]
+        if w is None:
+            self.ctp = np.cumsum(y, dtype=np.int64)
+            self.cn = np.arange(1, len(y) + 1, dtype=np.int64)
+        else:
+            w = np.asarray(w, dtype=np.float64)[order]
+            self.ctp = np.cumsum(y * w)
+            self.cn = np.cumsum(w)
+        self.pos = self.ctp[-1] if len(y) else 0
+        self.neg = (self.cn[-1] if len(y) else 0) - self.pos
+
+    def _counts(self, k):
+        # confusion counts when the top-k rows are predicted positive
+        km1 = np.maximum(k - 1, 0)
+        tp = np.where(k > 0, self.ctp[km1], 0)
+        fp = np.where(k > 0, self.cn[km1], 0) - tp
+        return tp, fp, self.pos - tp, self.neg - fp
+
+    def at(self, thresholds):
+        # -> tp, fp, fn, tn for the given thresholds (any order)
+        t = np.asarray(thresholds, dtype=np.float64)
+        k = len(self.ps) - np.searchsorted(self.ps[::-1], t, side="left")
+        return self._counts(k)
+
+    def curve(self):
+        # -> thresholds (descending, starting with +inf = predict none), tp, fp, fn, tn
+        last = np.r_[np.flatnonzero(self.ps[1:] != self.ps[:-1]), len(self.ps) - 1]   # end of each tied run
+        k = np.r_[0, last + 1]
+        return (np.r_[np.inf, self.ps[last]],) + self._counts(k)
+
+def cost(tp, fp, fn, tn, ccfg):
+    return (ccfg.get("c_tp", 0.0)*tp + ccfg.get("c_fp", 0.0)*fp
+            + ccfg.get("c_fn", 0.0)*fn + ccfg.get("c_tn", 0.0)*tn)
+
+def threshold_costs(y, p, thresholds, ccfg, w=None, sweep: Sweep = None):
+    # expected cost at each configured threshold
+    return cost(*(sweep or Sweep(y, p, w)).at(thresholds), ccfg)
+
+def optimal_threshold(y, p, ccfg, w=None, sweep: Sweep = None):
+    # exact cost-optimal cut over all distinct scores -> (threshold, cost);
+    # threshold +inf means predicting no positives is cheapest
+    th, tp, fp, fn, tn = (sweep or Sweep(y, p, w)).curve()
+    c = cost(tp, fp, fn, tn, ccfg)
+    i = int(np.argmin(c))
+    return float(th[i]), float(c[i])
+
+def json_threshold(th):
+    # +inf ("predict no positives") -> None, since JSON has no infinity
+    return None if np.isinf(th) else float(th)
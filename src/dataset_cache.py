@@ -0,0 +1,195 @@
+import os, json, shutil, xgboost as xgb
+from xgboost import XGBClassifier
+from catboost import CatBoostClassifier, Pool
+from joblib import hash as joblib_hash
+
+# Quantized training data built once per (split, feature set) and reused across
+# seeds, hyperparameter trials and ablation runs, so histogram binning is not
+# redone on every fit. XGBoost QuantileDMatrix objects live in-process (xgboost
+# can only serialise plain DMatrix); CatBoost quantized Pools are also saved to
+# persist_dir when given and reloaded by later runs. fit_estimator adds early
+# stopping on the valid months and checkpoint/resume for long boosting runs.
+
+MAXIMIZE = ("auc", "aucpr", "pre", "map", "ndcg")      # as xgboost's EarlyStopping
+
+class _EarlyStopping(xgb.callback.TrainingCallback):
+    # Early stopping on the last valid metric, kept in the booster's best_score /
+    # best_iteration attributes, so a resumed checkpoint continues from its best
+    # round instead of treating the first resumed round as the best.
+    def __init__(self, rounds: int):
+        self.rounds = rounds
+        super().__init__()
+
+    def after_iteration(self, model, epoch, evals_log):
+        metric, scores = list(evals_log["valid"].items())[-1]
+        score, it, best = float(scores[-1]), model.num_boosted_rounds() - 1, model.attr("best_score")
+        up = metric.startswith(MAXIMIZE) and metric != "mape"
+        if best is None or (score > float(best) if up else score < float(best)):
+            model.set_attr(best_score=str(score), best_iteration=str(it))
+            return False
+        return it - int(model.attr("best_iteration")) >= self.rounds
+
+def _history(prior, evals_log):
+    # valid-metric history of a resumed run + this session's
+    out = {}
+    for name, metrics in evals_log.items():
+        out[name] = {m: list(prior.get(name, {}).get(m, [])) + [float(v) for v in vals] for m, vals in metrics.items()}
+    return out or prior
+
+class _Checkpoint(xgb.callback.TrainingCallback):
+    # booster and metric history every `interval` rounds, as model_<rounds>.json / .ubj
+    def __init__(self, directory: str, interval: int, prior: dict):
+        self.directory, self.interval, self.prior = directory, interval, prior
+        super().__init__()
+
+    def after_iteration(self, model, epoch, evals_log):
+        n = model.num_boosted_rounds()
+        if n % self.interval == 0:
+            path = os.path.join(self.directory, f"model_{n}")
+            with open(path + ".json", "w") as f:
+                json.dump(_history(self.prior, evals_log), f)
+            model.save_model(path + ".ubj")
+        return False
+
+def _latest_checkpoint(checkpoint_dir):
+    # -> (newest readable booster, its metric history) in checkpoint_dir, or (None, {});
+    # a kill mid-save leaves a broken last file
+    if not os.path.isdir(checkpoint_dir):
+        return None, {}
+    files = [f for f in os.listdir(checkpoint_dir) if f.startswith("model_") and f.endswith(".ubj")]
+    for f in sorted(files, key=lambda f: int(f[6:-4]), reverse=True):
+        try:
+            booster = xgb.Booster(model_file=os.path.join(checkpoint_dir, f))
+            with open(os.path.join(checkpoint_dir, f[:-4] + ".json")) as fh:
+                return booster, json.load(fh)
+        except (xgb.core.XGBoostError, OSError, ValueError):
+            continue
+    return None, {}
+
+def checkpoint_run(checkpoint_dir: str, clf, *data) -> str:
+    # checkpoint_dir/<hash of params and data>: only a run with the same params and
+    # data resumes; checkpoints of other runs are removed
+    params = {k: v for k, v in clf.get_params().items() if k not in ("n_jobs", "nthread", "thread_count", "verbose")}
+    run = joblib_hash((type(clf).__name__, params, [joblib_hash(d) for d in data]))
+    if os.path.isdir(checkpoint_dir):
+        for d in os.listdir(checkpoint_dir):
+            if d != run:
+                shutil.rmtree(os.path.join(checkpoint_dir, d), ignore_errors=True)
+    return os.path.join(checkpoint_dir, run)
+
+def fit_booster(clf: XGBClassifier, dtrain, dvalid=None, early_stopping_rounds: int = None,
+                checkpoint_dir: str = None, checkpoint_every: int = 50):
+    # Train clf's configuration on a prebuilt DMatrix and load the booster back into
+    # clf, giving the same model as clf.fit on the raw matrix. With dvalid, stops
+    # after early_stopping_rounds without improvement (best_iteration is kept and
+    # used by predict_proba); with checkpoint_dir (see checkpoint_run), saves the
+    # booster every checkpoint_every rounds and resumes from the newest checkpoint.
+    rounds, start, prior, callbacks = clf.get_num_boosting_rounds(), None, {}, []
+    if early_stopping_rounds and dvalid is not None:
+        callbacks.append(_EarlyStopping(early_stopping_rounds))
+    if checkpoint_dir:
+        start, prior = _latest_checkpoint(checkpoint_dir)
+        if start is not None:
+            print(f"[checkpoint] resuming {checkpoint_dir} at round {start.num_boosted_rounds()}")
+            rounds -= start.num_boosted_rounds()
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        # after early stopping, so saved boosters carry this round's best_* attributes
+        callbacks.append(_Checkpoint(checkpoint_dir, checkpoint_every, prior))
+    evals_log = {}
+    booster = xgb.train(clf.get_xgb_params(), dtrain, num_boost_round=max(rounds, 0),
+                        evals=[(dvalid, "valid")] if dvalid is not None else (),
+                        callbacks=callbacks, xgb_model=start, verbose_eval=False, evals_result=evals_log)
+    clf.load_model(bytearray(booster.save_raw()))
+    if dvalid is not None:
+        clf.evals_result_ = _history(prior, evals_log)
+    if checkpoint_dir:
+        # finished: a rerun must train afresh, not continue this model
+        shutil.rmtree(checkpoint_dir, ignore_errors=True)
+    return clf
+
+def fit_estimator(clf, Z, y, Zva=None, yva=None, early_stopping_rounds: int = None,
+                  checkpoint_dir: str = None, checkpoint_every: int = 50, checkpoint_secs: int = 600,
+                  cache=None, key=None):
+    # Fits a transformed split with optional early stopping on (Zva, yva) and
+    # checkpoint/resume for XGBoost (every checkpoint_every rounds) and CatBoost
+    # (snapshots every checkpoint_secs); cache: a QuantizedCache for the train data.
+    es = early_stopping_rounds if Zva is not None else None
+    run_dir = checkpoint_run(checkpoint_dir, clf, Z, y, Zva, yva, es) if checkpoint_dir else None
+    if isinstance(clf, XGBClassifier) and (cache or es or checkpoint_dir):
+        dtrain = cache.xgb_train(key, Z, y, clf) if cache else _quantile_dmatrix(Z, y, clf)
+        dvalid = _quantile_dmatrix(Zva, yva, clf, ref=dtrain) if es else None
+        fit_booster(clf, dtrain, dvalid, es, run_dir, checkpoint_every)
+        if checkpoint_dir:
+            shutil.rmtree(checkpoint_dir, ignore_errors=True)
+        return clf
+    if isinstance(clf, CatBoostClassifier) and (cache or es or checkpoint_dir):
+        kw = {}
+        if es:
+            kw.update(eval_set=Pool(Zva, yva, cat_features=clf.get_params().get("cat_features")),
+                      early_stopping_rounds=es)
+        if checkpoint_dir:
+            os.makedirs(run_dir, exist_ok=True)
+            kw.update(save_snapshot=True, snapshot_file=os.path.join(run_dir, "snapshot.cbsnapshot"),
+                      snapshot_interval=checkpoint_secs)
+        if cache:
+            clf.fit(cache.catboost_train(key, Z, y, clf), **kw)
+        else:
+            clf.fit(Z, y, **kw)
+        if checkpoint_dir:
+            shutil.rmtree(checkpoint_dir, ignore_errors=True)
+        return clf
+    return clf.fit(Z, y)
+
+def best_iteration(clf):
+    # best boosting round found by early stopping, or None
+    if isinstance(clf, XGBClassifier):
+        try:
+            return int(clf.best_iteration)
+        except AttributeError:
+            return None
+    if isinstance(clf, CatBoostClassifier):
+        return clf.get_best_iteration()
+    return None
+
+def _quantile_dmatrix(Z, y, clf: XGBClassifier, ref=None):
+    return xgb.QuantileDMatrix(Z, y, max_bin=clf.get_xgb_params().get("max_bin") or 256, ref=ref,
+                               enable_categorical=bool(clf.get_params().get("enable_categorical")))
+
+class QuantizedCache:
+    def __init__(self, persist_dir: str = None):
+        self.persist_dir = persist_dir
+        self._store = {}
+        if persist_dir:
+            os.makedirs(persist_dir, exist_ok=True)
+
+    def xgb_train(self, key, Z, y, clf: XGBClassifier):
+        max_bin = clf.get_xgb_params().get("max_bin") or 256
+        k = ("xgb", key, max_bin)
+        if k not in self._store:
+            self._store[k] = _quantile_dmatrix(Z, y, clf)
+        return self._store[k]
+
+    def catboost_train(self, key, Z, y, clf: CatBoostClassifier):
+        params = clf.get_params()
+        border_count = params.get("border_count")
+        k = ("cat", key, border_count)
+        if k in self._store:
+            return self._store[k]
+        path = None
+        if self.persist_dir:
+            # on disk the key must identify the data itself, not just the split name
+            path = os.path.join(self.persist_dir, f"{joblib_hash((k, joblib_hash(Z), joblib_hash(y)))}.qpool")
+        if path and os.path.exists(path):
+            pool = Pool(f"quantized://{path}")
+        else:
+            pool = Pool(Z, y, cat_features=params.get("cat_features"))
+            pool.quantize(**({"border_count": border_count} if border_count else {}))
+            if path:
+                pool.save(path)
+        self._store[k] = pool
+        return pool
+
+    def fit(self, clf, key, Z, y, **kw):
+        # Fit an sklearn-API booster from the cached quantized data (same model as
+        # clf.fit(Z, y)); other estimators are fit as usual. kw: see fit_estimator.
+        return fit_estimator(clf, Z, y, cache=self, key=key, **kw)
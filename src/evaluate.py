@@ -1,32 +1,41 @@
 import os, json, glob, argparse, numpy as np, pandas as pd, yaml
 from sklearn.metrics import roc_auc_score, average_precision_score, brier_score_loss
 from joblib import load
+from .preprocess import read_processed
+from .feature_cache import FeatureCache
+from .prediction_store import store_from_config
+from .models import model_roster, stack_predictions
+from .cost_sweep import Sweep, threshold_costs, optimal_threshold, cost, json_threshold
+from .bootstrap import bootstrap, percentile_ci
+from .streaming_metrics import MetricAccumulator
+from .external_memory import iter_frames, month_files
+from .scheduler import run_parallel
+from .segments import sliced_metrics, SegmentThresholds
+from .quick_eval import sequential_sample, TestRows, QUICK_METRICS
 
 def load_config(path: str):
     import yaml
     with open(path, "r") as f:
         return yaml.safe_load(f)
 
-def load_splits(processed_dir, months, label_col):
+def load_splits(processed_dir, months, label_col, columns=None, filters=None, cache_dir=None):
+    # columns: features to read (label is always added); filters: [[col, op, value], ...]
+    # cache_dir: serve months from the shared mmap FeatureCache instead of parquet
+    if cache_dir:
+        return FeatureCache(cache_dir, processed_dir, label_col).load_splits(months, columns, filters)
+    if columns is not None and label_col not in columns:
+        columns = list(columns) + [label_col]
     frames = []
     for m in months:
         fp = os.path.join(processed_dir, f"table_{m}.parquet")
         if not os.path.exists(fp):
             raise FileNotFoundError(fp)
-        frames.append(pd.read_parquet(fp))
+        frames.append(read_processed(fp, columns=columns, filters=filters))
     df = pd.concat(frames, ignore_index=True)
     X = df.drop(columns=[label_col])
     y = df[label_col].astype(int).values
     return X, y
 
-def expected_cost(y_true, y_prob, threshold, c_fp, c_fn, c_tp=0.0, c_tn=0.0):
-    y_pred = (y_prob >= threshold).astype(int)
-    fp = ((y_pred==1) & (y_true==0)).sum()
-    fn = ((y_pred==0) & (y_true==1)).sum()
-    tp = ((y_pred==1) & (y_true==1)).sum()
-    tn = ((y_pred==0) & (y_true==0)).sum()
-    return c_fp*fp + c_fn*fn + c_tp*tp + c_tn*tn
-
 def summarize_mean_std(dicts):
     # dicts: list of {model: {metric: value}}
     models = sorted({m for d in dicts for m in d.keys()})
@@ -35,65 +44,225 @@ def summarize_mean_std(dicts):
         metrics = {}
         all_metrics = sorted({k for d in dicts if m in d for k in d[m].keys()})
         for k in all_metrics:
-            vals = [d[m][k] for d in dicts if m in d and k in d[m]]
+            vals = [d[m][k] for d in dicts if m in d and k in d[m] and d[m][k] is not None]
+            if not vals:
+                continue
             metrics[k] = {"mean": float(np.mean(vals)), "std": float(np.std(vals))}
         out[m] = metrics
     return out
 
+def score_metrics(yte, p, ccfg):
+    # -> (metrics, per-threshold cost table) from in-memory scores
+    roc = roc_auc_score(yte, p)
+    pr = average_precision_score(yte, p)
+    brier = brier_score_loss(yte, p)
+
+    # cost-sensitive sweep: configured grid, plus the exact optimum over all scores
+    sweep = Sweep(yte, p)
+    ecs = threshold_costs(yte, p, ccfg["thresholds"], ccfg, sweep=sweep)
+    costs = [{"threshold": th, "expected_cost": float(ec)} for th, ec in zip(ccfg["thresholds"], ecs)]
+    best = min(costs, key=lambda x: x["expected_cost"])
+    opt_th, opt_cost = optimal_threshold(yte, p, ccfg, sweep=sweep)
+
+    metrics = {
+        "roc_auc": float(roc),
+        "pr_auc": float(pr),
+        "brier": float(brier),
+        "best_threshold": best["threshold"],
+        "min_expected_cost": best["expected_cost"],
+        "opt_threshold": json_threshold(opt_th),
+        "opt_expected_cost": opt_cost
+    }
+    return metrics, costs
+
+def stream_month(seed, month, cfg, filters, batch_rows):
+    # {model name: MetricAccumulator} for one seed's roster on one test month,
+    # scored one record batch at a time (all models on each batch, stack included)
+    dcfg, label = cfg["data"], cfg["data"]["label_col"]
+    names, members = model_roster(cfg)
+    mdls = {n: load(f"models/seed_{seed}/{n}.joblib") for n in names}
+    accs = {n: MetricAccumulator(cfg["costs"]["thresholds"]) for n in names + (["stack"] if members else [])}
+    for df in iter_frames(month_files(dcfg["processed_dir"], [month]), batch_rows=batch_rows, filters=filters):
+        if not len(df):
+            continue
+        y, X = df[label].to_numpy().astype(int), df.drop(columns=[label])
+        ps = {n: mdl.predict_proba(X)[:, 1] for n, mdl in mdls.items()}
+        if members:
+            ps["stack"] = stack_predictions(np.vstack([ps[n] for n in members]))
+        for n, p in ps.items():
+            accs[n].update(y, p)
+    return accs
+
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--cfg", type=str, required=True)
     ap.add_argument("--seeds", type=int, nargs="+", default=[42,43,44])
+    ap.add_argument("--filter", nargs=3, action="append", default=[], metavar=("COL","OP","VALUE"),
+                    help="row filter pushed down to parquet, e.g. --filter hour '>=' 7 --filter payment_type in 1,2")
+    ap.add_argument("--slice_name", type=str, default="", help="suffix for output files of a sliced evaluation")
+    ap.add_argument("--n_boot", type=int, default=0, help="bootstrap replicates for 95%% CIs (0: none)")
+    ap.add_argument("--boot_seed", type=int, default=0)
+    ap.add_argument("--jobs", type=int, default=1, help="processes for bootstrap replicates / streamed months")
+    ap.add_argument("--streaming", action="store_true",
+                    help="score test months batch-wise into mergeable accumulators (memory independent of rows)")
+    ap.add_argument("--batch_rows", type=int, default=1_000_000, help="rows per batch with --streaming")
+    ap.add_argument("--segment_by", nargs="+", action="append", default=[], metavar="COL",
+                    help="per-segment metrics, e.g. --segment_by PULocationID hour --segment_by payment_type")
+    ap.add_argument("--min_segment_rows", type=int, default=1)
+    ap.add_argument("--segment_thresholds", nargs="+", default=None, metavar="COL",
+                    help="cost-optimal threshold per segment, chosen on the valid months, e.g. --segment_thresholds hour VendorID")
+    ap.add_argument("--threshold_search", type=str, default="grid", choices=["grid","exact"],
+                    help="grid: costs.thresholds; exact: every distinct valid score")
+    ap.add_argument("--min_threshold_rows", type=int, default=500, help="smaller segments keep the global valid threshold")
+    ap.add_argument("--quick", action="store_true",
+                    help="score a (month, label)-stratified sample grown until metric CIs are within --precision")
+    ap.add_argument("--precision", type=float, default=0.001, help="target 95%% CI half-width with --quick")
+    ap.add_argument("--quick_metrics", nargs="+", default=list(QUICK_METRICS), choices=list(QUICK_METRICS))
+    ap.add_argument("--quick_start", type=int, default=20000, help="first sample size with --quick")
     args = ap.parse_args()
+    if (args.streaming or args.quick) and (args.segment_by or args.segment_thresholds):
+        ap.error("--segment_by / --segment_thresholds need all test rows (not --streaming / --quick)")
+    if args.streaming and args.quick:
+        ap.error("--streaming and --quick are exclusive")
 
     cfg = load_config(args.cfg)
     dcfg, mcfg, ccfg = cfg["data"], cfg["models"], cfg["costs"]
 
-    # Load test split
-    Xte, yte = load_splits(dcfg["processed_dir"], dcfg["test_months"], dcfg["label_col"])
+    # Load test split (not needed when scores come from the prediction store)
+    filters = (dcfg.get("filters") or []) + args.filter
+    store = store_from_config(dcfg)
+    if store is None and not (args.streaming or args.quick):
+        Xte, yte = load_splits(dcfg["processed_dir"], dcfg["test_months"], dcfg["label_col"],
+                               filters=filters, cache_dir=dcfg.get("feature_cache_dir"))
+    # preprocessor outputs are cached per month, so only for unfiltered test months
+    cache = None
+    if dcfg.get("feature_cache_dir") and not filters:
+        cache = FeatureCache(dcfg["feature_cache_dir"], dcfg["processed_dir"], dcfg["label_col"])
+    sfx = f"_{args.slice_name}" if args.slice_name else ""
+    names, members = model_roster(cfg)
+    seg_tables = []
+    key_cols = list(dict.fromkeys([c for by in args.segment_by for c in by] + (args.segment_thresholds or [])))
+    if key_cols:
+        te_keys = Xte[key_cols] if store is None else \
+            load_splits(dcfg["processed_dir"], dcfg["test_months"], dcfg["label_col"], columns=key_cols, filters=filters)[0]
+    if args.segment_thresholds:
+        # valid rows as scored by train (<name>_valid.npy): same months and config filters
+        va_keys, yva = load_splits(dcfg["processed_dir"], dcfg["valid_months"], dcfg["label_col"],
+                                   columns=args.segment_thresholds, filters=dcfg.get("filters"))
+        grid = ccfg["thresholds"] if args.threshold_search == "grid" else None
+
+    # bootstrap metric -> reported metric it gives a CI for
+    ci_keys = {"roc_auc": "roc_auc", "pr_auc": "pr_auc", "brier": "brier", "expected_cost": "min_expected_cost"}
+    results, cis = [], []
+    streamed = {}
+    if args.streaming:
+        # (seed, month) tasks in parallel; month accumulators merge into one per seed and model
+        tasks = [(seed, m, cfg, filters, args.batch_rows) for seed in args.seeds for m in dcfg["test_months"]]
+        for task, accs in zip(tasks, run_parallel(stream_month, tasks, jobs=args.jobs)):
+            seen = streamed.setdefault(task[0], {})
+            for n, acc in accs.items():
+                if n in seen:
+                    seen[n].merge(acc)
+                else:
+                    seen[n] = acc
+    quick = {}
+    if args.quick:
+        # labels from a label-only pass; features are read for sampled rows only
+        rows = TestRows(dcfg["processed_dir"], dcfg["test_months"], dcfg["label_col"], filters,
+                        dcfg.get("feature_cache_dir"))
+        yte = rows.y
+        for seed in args.seeds:
+            mdls = {n: load(f"models/seed_{seed}/{n}.joblib") for n in names}
 
-    results = []
+            def score(idx):
+                X = rows.features(idx)
+                ps = {n: mdl.predict_proba(X)[:, 1] for n, mdl in mdls.items()}
+                if members:
+                    ps["stack"] = stack_predictions(np.vstack([ps[n] for n in members]))
+                return ps
+            quick[seed] = sequential_sample(rows.strata, yte, score, args.precision, args.quick_metrics,
+                                            args.quick_start, seed=args.boot_seed, jobs=args.jobs)
     for seed in args.seeds:
         seed_dir = f"models/seed_{seed}"
-        metrics = {}
-        for name in ["xgb"]:
-            model_path = os.path.join(seed_dir, f"{name}.joblib")
-            mdl = load(model_path)
-            p = mdl.predict_proba(Xte)[:,1]
-
-            # base metrics
-            roc = roc_auc_score(yte, p)
-            pr = average_precision_score(yte, p)
-            brier = brier_score_loss(yte, p)
-
-            # cost-sensitive sweep
-            costs = []
-            for th in ccfg["thresholds"]:
-                ec = expected_cost(yte, p, th, ccfg["c_fp"], ccfg["c_fn"], ccfg["c_tp"], ccfg["c_tn"])
-                costs.append({"threshold": th, "expected_cost": float(ec)})
-            best = min(costs, key=lambda x: x["expected_cost"])
-
-            metrics[name] = {
-                "roc_auc": float(roc),
-                "pr_auc": float(pr),
-                "brier": float(brier),
-                "best_threshold": best["threshold"],
-                "min_expected_cost": best["expected_cost"]
-            }
+        metrics, preds, ci = {}, {}, {}
+        for name in names + (["stack"] if members else []):
+            if quick:
+                # sample estimates; costs scaled from the sample to all test rows
+                idx, qp, hw, rounds = quick[seed]
+                metrics[name], costs = score_metrics(yte[idx], qp[name], ccfg)
+                scale = len(yte) / len(idx)
+                for c in costs:
+                    c["expected_cost"] *= scale
+                metrics[name]["min_expected_cost"] *= scale
+                metrics[name]["opt_expected_cost"] *= scale
+                metrics[name].update(n_sampled=len(idx), quick_rounds=rounds, **{f"hw_{k}": v for k, v in hw[name].items()})
+            elif streamed:
+                # histogram AUCs; no bootstrap CIs without row-level scores
+                acc = streamed[seed][name]
+                metrics[name] = acc.result(ccfg)
+                costs = [{"threshold": th, "expected_cost": float(ec)}
+                         for th, ec in zip(ccfg["thresholds"], acc.costs(ccfg))]
+            else:
+                if name == "stack":
+                    # base-model test scores from this loop, no re-prediction
+                    p = stack_predictions(np.vstack([preds[n] for n in members]))
+                else:
+                    model_path = os.path.join(seed_dir, f"{name}.joblib")
+                    if store:
+                        sc = store.scores(model_path, seed, dcfg["test_months"], filters)
+                        p, yte = sc["score"].to_numpy(), sc["label"].to_numpy().astype(int)
+                    else:
+                        mdl = load(model_path)
+                        p = cache.predict_proba(mdl, dcfg["test_months"]) if cache else mdl.predict_proba(Xte)[:,1]
+                    preds[name] = p
+                metrics[name], costs = score_metrics(yte, p, ccfg)
+                if args.n_boot:
+                    # test-set sampling CI; cost at this seed's best threshold
+                    reps = bootstrap(yte, p, n_boot=args.n_boot, seed=args.boot_seed, jobs=args.jobs,
+                                     threshold=metrics[name]["best_threshold"], ccfg=ccfg, which=tuple(ci_keys))
+                    ci[name] = {ci_keys[k]: v for k, v in percentile_ci(reps).items()}
+                if args.segment_thresholds:
+                    # fit on valid scores, apply per row on test, export next to the model for serve.py
+                    p_va = np.load(os.path.join(seed_dir, f"{name}_valid.npy")) if name != "stack" else \
+                        stack_predictions(np.vstack([np.load(os.path.join(seed_dir, f"{n}_valid.npy")) for n in members]))
+                    st = SegmentThresholds.fit(va_keys, yva, p_va, ccfg, grid, args.min_threshold_rows)
+                    hit = p >= st.apply(te_keys)
+                    tp, fp = int((hit & (yte == 1)).sum()), int((hit & (yte == 0)).sum())
+                    metrics[name].update(
+                        valid_threshold=json_threshold(st.default),
+                        valid_threshold_cost=float(threshold_costs(yte, p, [st.default], ccfg)[0]),
+                        segment_threshold_cost=float(cost(tp, fp, int(yte.sum()) - tp, int((yte == 0).sum()) - fp, ccfg)),
+                        n_threshold_segments=len(st.table))
+                    st.save(os.path.join(seed_dir, f"{name}_thresholds.json"))
+                if args.segment_by:
+                    seg = sliced_metrics(te_keys, args.segment_by, yte, p, ccfg, metrics[name]["best_threshold"],
+                                         min_rows=args.min_segment_rows)
+                    seg.insert(0, "model", name)
+                    seg.insert(0, "seed", seed)
+                    seg_tables.append(seg)
             # save per-model threshold table
             os.makedirs("reports/metrics", exist_ok=True)
-            with open(f"reports/metrics/test_thresholds_seed_{seed}_{name}.json", "w") as f:
+            with open(f"reports/metrics/test_thresholds_seed_{seed}_{name}{sfx}.json", "w") as f:
                 json.dump(costs, f, indent=2)
 
-        with open(f"reports/metrics/test_seed_{seed}.json", "w") as f:
-            json.dump(metrics, f, indent=2)
+        with open(f"reports/metrics/test_seed_{seed}{sfx}.json", "w") as f:
+            json.dump({n: {**m, "ci95": ci[n]} if n in ci else m for n, m in metrics.items()}, f, indent=2)
 
         results.append(metrics)
+        cis.append(ci)
 
-    # mean±std
+    # mean±std, plus the per-seed bootstrap CI bounds averaged over seeds (not itself a 95% interval)
     agg = summarize_mean_std(results)
+    for m in agg:
+        for k in ci_keys.values():
+            bounds = [c[m][k] for c in cis if m in c]
+            if bounds:
+                agg[m][k]["ci95_seed_mean"] = np.mean(bounds, axis=0).tolist()
+    if seg_tables:
+        os.makedirs("reports/segments", exist_ok=True)
+        pd.concat(seg_tables, ignore_index=True).to_parquet(f"reports/segments/segments{sfx}.parquet", index=False)
     os.makedirs("reports/summary", exist_ok=True)
-    with open("reports/summary/metrics_mean_std.json", "w") as f:
+    with open(f"reports/summary/metrics_mean_std{sfx}.json", "w") as f:
         json.dump(agg, f, indent=2)
 
     print(json.dumps(agg, indent=2))
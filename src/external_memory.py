@@ -0,0 +1,112 @@
+import os, shutil, tempfile, numpy as np, pandas as pd, xgboost as xgb
+import pyarrow as pa, pyarrow.parquet as pq
+from xgboost import XGBClassifier
+from sklearn.pipeline import Pipeline
+from .models import TreeFeatures
+from .preprocess import table_to_frame, parse_filters
+from .dataset_cache import fit_booster, checkpoint_run
+
+# Out-of-core XGBoost over processed month files: record batches are streamed
+# through TreeFeatures into an external-memory quantile DMatrix whose pages are
+# cached on disk, so the train window is never resident as one DataFrame.
+
+def month_files(processed_dir, months):
+    files = [os.path.join(processed_dir, f"table_{m}.parquet") for m in months]
+    for fp in files:
+        if not os.path.exists(fp):
+            raise FileNotFoundError(fp)
+    return files
+
+def schema_frame(fp: str) -> pd.DataFrame:
+    # zero-row frame with the file's dtypes, for infer_feature_types
+    return pq.read_schema(fp).empty_table().to_pandas()
+
+def iter_frames(files, columns=None, batch_rows: int = 1_000_000, filters=None):
+    # filters ([[col, op, value], ...]) are applied to each batch; their columns are read too
+    for fp in files:
+        expr, cols = None, columns
+        if filters:
+            expr = pq.filters_to_expression(parse_filters(filters, pq.read_schema(fp)))
+            if columns is not None:
+                cols = list(dict.fromkeys(list(columns) + [f[0] for f in filters]))
+        for batch in pq.ParquetFile(fp).iter_batches(batch_size=batch_rows, columns=cols):
+            table = pa.Table.from_batches([batch])
+            yield table_to_frame(table if expr is None else table.filter(expr))
+
+def fit_tree_features(files, num_cols, cat_cols, batch_rows: int = 1_000_000, filters=None) -> TreeFeatures:
+    # Column order from the schema; categories from a projected pass over cat columns.
+    pre = TreeFeatures(num_cols, cat_cols).partial_fit(schema_frame(files[0]))
+    if cat_cols:
+        for df in iter_frames(files, list(cat_cols), batch_rows, filters):
+            pre.partial_fit(df)
+    return pre
+
+class MonthBatches(xgb.DataIter):
+    def __init__(self, files, label_col: str, pre: TreeFeatures, batch_rows: int = 1_000_000, cache_prefix: str = None,
+                 filters=None):
+        self.files, self.label_col, self.pre, self.batch_rows = files, label_col, pre, batch_rows
+        self.filters = filters
+        self._frames = None
+        super().__init__(cache_prefix=cache_prefix)
+
+    def reset(self):
+        self._frames = None
+
+    def next(self, input_data):
+        if self._frames is None:
+            self._frames = iter_frames(self.files, self.pre.feature_order_ + [self.label_col], self.batch_rows,
+                                       self.filters)
+        df = next(self._frames, None)
+        if df is None:
+            return 0
+        input_data(data=self.pre.transform(df), label=df[self.label_col].to_numpy())
+        return 1
+
+def _ext_dmatrix(it, max_bin, categorical, ref=None):
+    if hasattr(xgb, "ExtMemQuantileDMatrix"):
+        return xgb.ExtMemQuantileDMatrix(it, max_bin=max_bin, ref=ref, enable_categorical=categorical)
+    return xgb.DMatrix(it, enable_categorical=categorical)
+
+class ExternalTrainer:
+    # One external-memory DMatrix per train window, reused for every seed/params;
+    # valid_files: a second one, over the valid months, for early stopping.
+    def __init__(self, files, label_col: str, num_cols, cat_cols, max_bin: int = 256,
+                 batch_rows: int = 1_000_000, cache_dir: str = "data/cache/xgb_extmem", filters=None, valid_files=None):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.tmp = tempfile.mkdtemp(dir=cache_dir)
+        self.pre = fit_tree_features(files, num_cols, cat_cols, batch_rows, filters)
+        it = MonthBatches(files, label_col, self.pre, batch_rows, os.path.join(self.tmp, "page"), filters)
+        self.dtrain = _ext_dmatrix(it, max_bin, bool(cat_cols))
+        self.dvalid = None
+        if valid_files:
+            it = MonthBatches(valid_files, label_col, self.pre, batch_rows, os.path.join(self.tmp, "valid"), filters)
+            self.dvalid = _ext_dmatrix(it, max_bin, bool(cat_cols), ref=self.dtrain)
+        # identifies the data for checkpoint_run: files as of now, and the row filters
+        self.data_key = ([(fp, os.stat(fp).st_size, os.stat(fp).st_mtime_ns) for fp in list(files) + list(valid_files or [])],
+                         filters)
+
+    def fit(self, params, seed: int = None, early_stopping_rounds: int = None, checkpoint_dir: str = None,
+            checkpoint_every: int = 50) -> Pipeline:
+        # early stopping needs valid_files; see fit_booster for checkpoints
+        clf = XGBClassifier(**{"enable_categorical": bool(self.pre.cat_cols), **params})
+        if seed is not None:
+            clf.set_params(random_state=seed)
+        es = early_stopping_rounds if self.dvalid is not None else None
+        run_dir = checkpoint_run(checkpoint_dir, clf, self.data_key, es) if checkpoint_dir else None
+        fit_booster(clf, self.dtrain, self.dvalid if es else None, es, run_dir, checkpoint_every)
+        if checkpoint_dir:
+            shutil.rmtree(checkpoint_dir, ignore_errors=True)
+        return Pipeline([("pre", self.pre), ("clf", clf)])
+
+    def close(self):
+        self.dtrain = self.dvalid = None
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+def predict_files(mdl, files, label_col: str, batch_rows: int = 1_000_000, filters=None):
+    # Scores and labels for month files, one record batch at a time (rows in load_splits order).
+    columns = mdl[0].feature_order_ + [label_col]
+    ps, ys = [], []
+    for df in iter_frames(files, columns, batch_rows, filters):
+        ps.append(mdl.predict_proba(df)[:, 1])
+        ys.append(df[label_col].to_numpy().astype(int))
+    return np.concatenate(ps), np.concatenate(ys)
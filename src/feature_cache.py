@@ -0,0 +1,116 @@
+import os, json, shutil, numpy as np, pandas as pd
+import pyarrow as pa, pyarrow.parquet as pq
+from joblib import hash as joblib_hash
+from scipy import sparse
+from .preprocess import file_sha256, parse_filters, _NULLABLE_UINTS
+
+# Month-level cache of decoded processed tables (uncompressed Arrow IPC) and of
+# fitted-preprocessor outputs (.npy). Both are opened with mmap, so concurrent
+# train/evaluate/ablation/rolling jobs on one host share the OS page cache
+# instead of each decoding parquet into a private copy.
+#
+# layout: <cache_dir>/<month>/{meta.json, table.arrow, pre-<hash>.npy}
+
+def _fingerprint(fp: str, prev: dict = None) -> dict:
+    st = os.stat(fp)
+    if prev and prev["size"] == st.st_size and prev["mtime"] == st.st_mtime:
+        return prev
+    return {"size": st.st_size, "mtime": st.st_mtime, "sha256": file_sha256(fp)}
+
+def _frame(table: pa.Table) -> pd.DataFrame:
+    # Zero-copy views into the mapped buffers; only columns with nulls (nullable
+    # ints) are materialised.
+    cols = {}
+    for name, col in zip(table.column_names, table.columns):
+        if col.null_count or col.num_chunks != 1:
+            cols[name] = col.to_pandas(types_mapper=_NULLABLE_UINTS.get)
+        else:
+            cols[name] = col.chunk(0).to_numpy(zero_copy_only=False)
+    return pd.DataFrame(cols, copy=False)
+
+class FeatureCache:
+    def __init__(self, cache_dir: str, processed_dir: str, label_col: str):
+        self.cache_dir = cache_dir
+        self.processed_dir = processed_dir
+        self.label_col = label_col
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _source(self, m: str) -> str:
+        fp = os.path.join(self.processed_dir, f"table_{m}.parquet")
+        if not os.path.exists(fp):
+            raise FileNotFoundError(fp)
+        return fp
+
+    def _entry(self, m: str) -> str:
+        # Returns the entry dir for month m, (re)building it if the processed file changed.
+        fp = self._source(m)
+        entry = os.path.join(self.cache_dir, m)
+        meta_path = os.path.join(entry, "meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path, "r") as f:
+                meta = json.load(f)
+            src = _fingerprint(fp, meta["source"])
+            if src["sha256"] == meta["source"]["sha256"]:
+                if src is not meta["source"]:
+                    meta["source"] = src
+                    with open(meta_path, "w") as f:
+                        json.dump(meta, f, indent=2)
+                return entry
+            shutil.rmtree(entry, ignore_errors=True)
+
+        print("[cache] building", m)
+        tmp = f"{entry}.tmp{os.getpid()}"
+        os.makedirs(tmp, exist_ok=True)
+        table = pq.read_table(fp)
+        with pa.OSFile(os.path.join(tmp, "table.arrow"), "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as w:
+                w.write_table(table.combine_chunks())
+        with open(os.path.join(tmp, "meta.json"), "w") as f:
+            json.dump({"source": _fingerprint(fp), "n_rows": table.num_rows, "columns": table.column_names}, f, indent=2)
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            # another job built it concurrently
+            shutil.rmtree(tmp, ignore_errors=True)
+        return entry
+
+    def table(self, m: str) -> pa.Table:
+        path = os.path.join(self._entry(m), "table.arrow")
+        return pa.ipc.open_file(pa.memory_map(path, "r")).read_all()
+
+    def load_splits(self, months, columns=None, filters=None):
+        # Same contract as train.load_splits.
+        frames, labels = [], []
+        for m in months:
+            table = self.table(m)
+            if filters:
+                table = table.filter(pq.filters_to_expression(parse_filters(filters, table.schema)))
+            feats = [c for c in (table.column_names if columns is None else columns) if c != self.label_col]
+            frames.append(_frame(table.select(feats)))
+            labels.append(table[self.label_col].to_numpy())
+        X = frames[0] if len(frames) == 1 else pd.concat(frames, ignore_index=True)
+        y = np.concatenate(labels).astype(int)
+        return X, y
+
+    def transform(self, pre, months):
+        # Output of a fitted preprocessor, cached per (month, fitted state). Sparse
+        # outputs (one-hot heavy configs) and DataFrames (TreeFeatures) are returned uncached.
+        key = joblib_hash(pre)
+        outs = []
+        for m in months:
+            path = os.path.join(self._entry(m), f"pre-{key}.npy")
+            if not os.path.exists(path):
+                X, _ = self.load_splits([m])
+                Z = pre.transform(X)
+                if sparse.issparse(Z) or not isinstance(Z, np.ndarray):
+                    return pre.transform(self.load_splits(months)[0])
+                tmp = f"{path}.tmp{os.getpid()}.npy"
+                np.save(tmp, np.ascontiguousarray(Z))
+                os.replace(tmp, path)
+            outs.append(np.load(path, mmap_mode="r"))
+        return outs[0] if len(outs) == 1 else np.concatenate(outs)
+
+    def predict_proba(self, mdl, months):
+        # Positive-class scores of a fitted Pipeline on the cached months.
+        Z = self.transform(mdl[:-1], months)
+        return mdl[-1].predict_proba(Z)[:, 1]
@@ -1,6 +1,7 @@
 from dataclasses import dataclass
 from typing import Dict, Any
-import numpy as np
+import numpy as np, pandas as pd
+from sklearn.base import BaseEstimator, TransformerMixin
 from sklearn.compose import ColumnTransformer
 from sklearn.preprocessing import OneHotEncoder, StandardScaler
 from sklearn.pipeline import Pipeline
@@ -20,26 +21,109 @@ def make_preprocessor(num_cols, cat_cols):
         num_pipe = Pipeline([("impute", SimpleImputer(strategy="median")), ("scale", StandardScaler())])
         transformers.append(("num", num_pipe, num_cols))
     if cat_cols:
-        cat_pipe = Pipeline([("impute", SimpleImputer(strategy="most_frequent")), ("ohe", OneHotEncoder(handle_unknown="ignore", sparse=True))])
+        cat_pipe = Pipeline([("impute", SimpleImputer(strategy="most_frequent")), ("ohe", OneHotEncoder(handle_unknown="ignore", sparse_output=True))])
         transformers.append(("cat", cat_pipe, cat_cols))
     if not transformers:
         raise ValueError("No features provided")
     return ColumnTransformer(transformers)
 
+class TreeFeatures(BaseEstimator, TransformerMixin):
+    # Preprocessor for boosters: no imputation or scaling. Numeric columns are cast
+    # to float32 with NaN kept for the booster's native missing-value handling (a
+    # plain float32 matrix when there are no categoricals); cat_cols become pandas
+    # categoricals (XGBoost) or integer codes (CatBoost, -1 = missing/unseen) over
+    # the categories seen in fit.
+    def __init__(self, num_cols, cat_cols, cat_codes=False):
+        self.num_cols = num_cols
+        self.cat_cols = cat_cols
+        self.cat_codes = cat_codes
+
+    def _frame(self, X):
+        if isinstance(X, pd.DataFrame):
+            return X
+        # e.g. serve.py rows, given in the training column order
+        return pd.DataFrame(np.asarray(X), columns=self.feature_order_)
+
+    def fit(self, X, y=None):
+        for attr in ("feature_order_", "categories_"):
+            self.__dict__.pop(attr, None)
+        return self.partial_fit(X)
+
+    def partial_fit(self, X, y=None):
+        # Column order comes from the first call; categories are the union over all
+        # calls (cat columns only need to be present), for fitting over a stream.
+        if not hasattr(self, "feature_order_"):
+            used = set(self.num_cols) | set(self.cat_cols)
+            self.feature_order_ = [c for c in X.columns if c in used] if isinstance(X, pd.DataFrame) \
+                else list(self.num_cols) + list(self.cat_cols)
+            self.categories_ = {c: pd.Index([], dtype="int64") for c in self.cat_cols}
+        X = self._frame(X)
+        # int64 / str categories: what both boosters serialise reliably
+        for c in self.cat_cols:
+            if c not in X.columns:
+                continue
+            v = X[c].dropna()
+            cats = v.to_numpy(dtype="float64").astype("int64") if pd.api.types.is_numeric_dtype(v) else v.astype(str).to_numpy()
+            if len(cats):
+                self.categories_[c] = pd.Index(np.union1d(self.categories_[c].to_numpy(), np.unique(cats)) if len(self.categories_[c]) else np.unique(cats))
+        return self
+
+    def _codes(self, s: pd.Series) -> np.ndarray:
+        cats = self.categories_[s.name]
+        vals = s.to_numpy(dtype="float64", na_value=np.nan) if pd.api.types.is_numeric_dtype(s) else s.astype(str).to_numpy()
+        return cats.get_indexer(vals)
+
+    def transform(self, X):
+        if not self.cat_cols and not isinstance(X, pd.DataFrame):
+            return np.asarray(X, dtype="float32")
+        X = self._frame(X)
+        if not self.cat_cols:
+            # all-numeric: one float32 matrix, no DataFrame round trip
+            return X[list(self.num_cols)].to_numpy(dtype="float32", na_value=np.nan)
+        out = {c: X[c].to_numpy(dtype="float32", na_value=np.nan) for c in self.num_cols}
+        for c in self.cat_cols:
+            codes = self._codes(X[c])
+            out[c] = codes.astype("int32") if self.cat_codes else pd.Categorical.from_codes(codes, self.categories_[c])
+        return pd.DataFrame(out)
+
 def make_logreg(num_cols, cat_cols, C=1.0, max_iter=2000):
     pre = make_preprocessor(num_cols, cat_cols)
     clf = LogisticRegression(C=C, max_iter=max_iter, solver="saga", n_jobs=-1, penalty="l2", class_weight=None, verbose=0)
     return Pipeline([("pre", pre), ("clf", clf)])
 
-def make_xgb(num_cols, cat_cols, params: Dict[str, Any]):
-    pre = make_preprocessor(num_cols, cat_cols)
-    clf = XGBClassifier(**params)
+def make_xgb(num_cols, cat_cols, params: Dict[str, Any], native: bool = False):
+    if native:
+        pre = TreeFeatures(num_cols, cat_cols)
+        clf = XGBClassifier(**{"enable_categorical": bool(cat_cols), **params})
+    else:
+        pre = make_preprocessor(num_cols, cat_cols)
+        clf = XGBClassifier(**params)
     return Pipeline([("pre", pre), ("clf", clf)])
 
-def make_catboost(num_cols, cat_cols, params: Dict[str, Any]):
-    pre = make_preprocessor(num_cols, cat_cols)
-    clf = CatBoostClassifier(**params)
+def make_catboost(num_cols, cat_cols, params: Dict[str, Any], native: bool = False):
+    if native:
+        pre = TreeFeatures(num_cols, cat_cols, cat_codes=True)
+        clf = CatBoostClassifier(**{"cat_features": list(cat_cols) or None, **params})
+    else:
+        pre = make_preprocessor(num_cols, cat_cols)
+        clf = CatBoostClassifier(**params)
     return Pipeline([("pre", pre), ("clf", clf)])
 
+# relative fit cost per model, used to schedule the most expensive fits first
+# (override with training.model_cost)
+EXPECTED_COST = {"logreg": 1.0, "xgb": 3.0, "cat": 10.0}
+
+def model_roster(cfg):
+    # training.models, e.g. [logreg, xgb, cat, stack]; "stack" averages the base models
+    # listed in training.stack (default: every other model in the roster)
+    tcfg = cfg.get("training", {})
+    names = list(tcfg.get("models") or ["xgb"])
+    base = [n for n in names if n != "stack"]
+    members = list(tcfg.get("stack") or base) if "stack" in names else []
+    missing = [n for n in members if n not in base]
+    if missing or ("stack" in names and not members):
+        raise ValueError(f"stack members must be base models in training.models: {missing or members}")
+    return base, members
+
 def stack_predictions(preds: np.ndarray) -> np.ndarray:
     return preds.mean(axis=0)
@@ -0,0 +1,79 @@
+import os
+from collections import OrderedDict
+import numpy as np, pandas as pd
+import pyarrow.parquet as pq
+from .train import load_splits
+
+# All processed months of a backtest loaded once, in month order, into one frame.
+# Contiguous month ranges (every expanding train window, single valid/test
+# months) are served as row-range views, so a window costs no I/O and no copy.
+
+class MonthStore:
+    def __init__(self, X: pd.DataFrame, y: np.ndarray, spans: dict):
+        self.X, self.y, self.spans = X, y, spans
+
+    @classmethod
+    def load(cls, processed_dir, months, label_col, columns=None, filters=None, cache_dir=None):
+        frames, labels, spans, n = [], [], {}, 0
+        for m in months:
+            X, y = load_splits(processed_dir, [m], label_col, columns=columns, filters=filters, cache_dir=cache_dir)
+            frames.append(X)
+            labels.append(y)
+            spans[m] = (n, n + len(y))
+            n += len(y)
+        return cls(pd.concat(frames, ignore_index=True), np.concatenate(labels), spans)
+
+    def window(self, months):
+        # -> (X, y) for months; a view when they are adjacent in the store
+        spans = [self.spans[m] for m in months]
+        if all(a[1] == b[0] for a, b in zip(spans, spans[1:])):
+            lo, hi = spans[0][0], spans[-1][1]
+            return self.X.iloc[lo:hi], self.y[lo:hi]
+        idx = np.concatenate([np.arange(lo, hi) for lo, hi in spans])
+        return self.X.iloc[idx].reset_index(drop=True), self.y[idx]
+
+def backtest_periods(processed_dir, months, time_col, step="month"):
+    # Backtest steps -> {label: (months to read, start, end)}. Months are whole
+    # files; weeks (Mon-Sun) and days are time_col slices of the files they
+    # overlap, labelled by start date, with empty periods skipped.
+    if step == "month":
+        return {m: ([m], None, None) for m in months}
+    span = pd.Timedelta(days=7 if step == "week" else 1)
+    found = {}
+    for m in months:
+        t = pd.to_datetime(pq.read_table(os.path.join(processed_dir, f"table_{m}.parquet"), columns=[time_col])
+                           .column(0).to_pandas()).dropna()
+        starts = t.dt.to_period("W-SUN").dt.start_time if step == "week" else t.dt.normalize()
+        for start in starts.unique():
+            found.setdefault(pd.Timestamp(start), []).append(m)
+    return {start.strftime("%Y-%m-%d"): (ms, start.isoformat(), (start + span).isoformat())
+            for start, ms in sorted(found.items())}
+
+class PeriodStore:
+    # Periods for sliding / sub-month backtests, read with time_col filters pushed
+    # down to parquet and kept in a ring buffer of `capacity` periods (None: keep
+    # all), so stepping a sliding window forward reads one new period and drops
+    # the oldest. Same window() contract as MonthStore.
+    def __init__(self, processed_dir, label_col, time_col, periods: dict, capacity: int = None, cache_dir=None):
+        self.processed_dir, self.label_col, self.time_col = processed_dir, label_col, time_col
+        self.periods, self.capacity, self.cache_dir = periods, capacity, cache_dir
+        self.buf = OrderedDict()
+
+    def _load(self, p):
+        months, start, end = self.periods[p]
+        filters = [[self.time_col, ">=", start], [self.time_col, "<", end]] if start else None
+        return load_splits(self.processed_dir, months, self.label_col, filters=filters, cache_dir=self.cache_dir)
+
+    def window(self, labels):
+        for p in labels:
+            if p in self.buf:
+                self.buf.move_to_end(p)
+                continue
+            self.buf[p] = self._load(p)
+            # never evict a period this call still needs
+            while len(self.buf) > max(self.capacity or len(self.buf), len(labels)):
+                self.buf.popitem(last=False)
+        if len(labels) == 1:
+            return self.buf[labels[0]]
+        X = pd.concat([self.buf[p][0] for p in labels], ignore_index=True)
+        return X, np.concatenate([self.buf[p][1] for p in labels])
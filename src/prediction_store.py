@@ -0,0 +1,113 @@
+import os, json, numpy as np, pandas as pd
+import pyarrow as pa, pyarrow.parquet as pq
+from joblib import load
+from .preprocess import file_sha256, read_processed, parse_filters
+from .feature_cache import FeatureCache, _fingerprint
+
+# Test-month scores of saved models, written once and served to evaluate,
+# calibration, stacking and plotting, so re-running an analysis with other cost
+# settings, bins or slices never re-scores a row. Keyed by the content hashes of
+# the model file and of the processed month, so a retrained model or a rebuilt
+# month gets fresh scores automatically.
+#
+# layout: <store_dir>/<model name>/<model sha256[:16]>/seed_<seed>/<month>-<month sha256[:16]>.parquet
+#         columns: <id_col> (when the data has it), label, score
+#         <store_dir>/sources.json: size, mtime and sha256 of each processed month last hashed
+
+class PredictionStore:
+    def __init__(self, store_dir: str, processed_dir: str, label_col: str, id_col: str = None, cache_dir: str = None):
+        self.store_dir = store_dir
+        self.processed_dir = processed_dir
+        self.label_col = label_col
+        self.id_col = id_col
+        self.cache_dir = cache_dir
+        self._sha = {}
+
+    def _model_key(self, model_path: str) -> str:
+        st = os.stat(model_path)
+        k = (model_path, st.st_size, st.st_mtime)
+        if k not in self._sha:
+            self._sha[k] = file_sha256(model_path)[:16]
+        return self._sha[k]
+
+    def _data_key(self, m: str) -> str:
+        # processed month's sha256, re-hashed only when its size or mtime changed
+        fp = os.path.join(self.processed_dir, f"table_{m}.parquet")
+        st = os.stat(fp)
+        k = (fp, st.st_size, st.st_mtime)
+        if k not in self._sha:
+            meta_path = os.path.join(self.store_dir, "sources.json")
+            meta = {}
+            if os.path.exists(meta_path):
+                with open(meta_path, "r") as f:
+                    meta = json.load(f)
+            src = _fingerprint(fp, meta.get(fp))
+            if src is not meta.get(fp):
+                meta[fp] = src
+                os.makedirs(self.store_dir, exist_ok=True)
+                tmp = f"{meta_path}.tmp{os.getpid()}"
+                with open(tmp, "w") as f:
+                    json.dump(meta, f, indent=2)
+                os.replace(tmp, meta_path)
+            self._sha[k] = src["sha256"][:16]
+        return self._sha[k]
+
+    def path(self, model_path: str, seed, month: str) -> str:
+        name = os.path.splitext(os.path.basename(model_path))[0]
+        return os.path.join(self.store_dir, name, self._model_key(model_path), f"seed_{seed}",
+                            f"{month}-{self._data_key(month)}.parquet")
+
+    def _score_month(self, mdl, m: str) -> pd.DataFrame:
+        if self.cache_dir:
+            cache = FeatureCache(self.cache_dir, self.processed_dir, self.label_col)
+            score = cache.predict_proba(mdl, [m])
+            table = cache.table(m)
+            y = table[self.label_col].to_numpy()
+            ids = table[self.id_col].to_numpy() if self.id_col in table.column_names else None
+        else:
+            df = read_processed(os.path.join(self.processed_dir, f"table_{m}.parquet"))
+            X = df.drop(columns=[self.label_col])
+            score = mdl.predict_proba(X)[:, 1]
+            y = df[self.label_col].to_numpy()
+            ids = df[self.id_col].to_numpy() if self.id_col in df.columns else None
+        out = {} if ids is None else {self.id_col: ids}
+        out.update(label=y.astype(np.int8), score=np.asarray(score, dtype=np.float64))
+        return pd.DataFrame(out)
+
+    def _rows(self, m: str, filters) -> np.ndarray:
+        # positions of the month's rows passing filters
+        fp = os.path.join(self.processed_dir, f"table_{m}.parquet")
+        table = pq.read_table(fp, columns=list(dict.fromkeys(f[0] for f in filters)))
+        table = table.append_column("__row", pa.array(np.arange(table.num_rows)))
+        expr = pq.filters_to_expression(parse_filters(filters, pq.read_schema(fp)))
+        return table.filter(expr).column("__row").to_numpy()
+
+    def scores(self, model_path: str, seed, months, filters=None) -> pd.DataFrame:
+        # -> rows of `months` in file order with label and score, scoring (and
+        # saving) only months not stored yet. filters ([[col, op, value], ...]) are
+        # evaluated on just the filter columns of the processed month and select
+        # stored rows by position, so ids need not be unique.
+        frames, mdl = [], None
+        for m in months:
+            fp = self.path(model_path, seed, m)
+            if not os.path.exists(fp):
+                if mdl is None:
+                    mdl = load(model_path)
+                print(f"[predictions] scoring {model_path} on {m}")
+                df = self._score_month(mdl, m)
+                os.makedirs(os.path.dirname(fp), exist_ok=True)
+                tmp = f"{fp}.tmp{os.getpid()}"
+                pq.write_table(pa.Table.from_pandas(df, preserve_index=False), tmp)
+                os.replace(tmp, fp)
+            df = pq.read_table(fp).to_pandas()
+            if filters:
+                df = df.iloc[self._rows(m, filters)]
+            frames.append(df)
+        return frames[0].reset_index(drop=True) if len(frames) == 1 else pd.concat(frames, ignore_index=True)
+
+def store_from_config(dcfg: dict):
+    # data.prediction_store_dir enables the store; None when unset
+    if not dcfg.get("prediction_store_dir"):
+        return None
+    return PredictionStore(dcfg["prediction_store_dir"], dcfg["processed_dir"], dcfg["label_col"],
+                           dcfg.get("id_col"), dcfg.get("feature_cache_dir"))
@@ -1,4 +1,7 @@
-import argparse, os, pandas as pd, numpy as np
+import argparse, os, glob, json, shutil, hashlib, inspect, pandas as pd, numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass, asdict
+import pyarrow as pa, pyarrow.parquet as pq
 from pathlib import Path
 
 def compute_tip_rate(df: pd.DataFrame) -> pd.Series:
@@ -8,7 +11,37 @@ def compute_tip_rate(df: pd.DataFrame) -> pd.Series:
     tip_rate = tip_rate.clip(lower=0, upper=1).fillna(0.0)
     return tip_rate
 
-def engineer_features(df: pd.DataFrame, time_col: str) -> pd.DataFrame:
+# Compact schema: small unsigned ints for calendar parts and ID-like categoricals
+# (nullable where the raw data has nulls). Parquet dictionary-encodes them on disk.
+COMPACT_DTYPES = {"hour": "uint8", "dow": "uint8", "month": "uint8", "year": "uint16",
+                  "passenger_count": "UInt8", "PULocationID": "UInt16", "DOLocationID": "UInt16",
+                  "payment_type": "UInt8", "VendorID": "UInt8", "RatecodeID": "UInt8"}
+
+@dataclass
+class OutputFormat:
+    compact: bool = False
+    compression: str = "snappy"
+    compression_level: int = None
+    row_group_size: int = None
+
+    def writer_kwargs(self):
+        return {"compression": self.compression, "compression_level": self.compression_level}
+
+def to_compact(df: pd.DataFrame) -> pd.DataFrame:
+    out = df.copy()
+    for col, dtype in COMPACT_DTYPES.items():
+        if col not in out.columns:
+            continue
+        if dtype[0].isupper():
+            # out-of-range codes become null rather than wrapping around
+            info = np.iinfo(dtype.lower())
+            v = out[col].astype("float64")
+            out[col] = v.where(v.between(info.min, info.max)).round().astype(dtype)
+        else:
+            out[col] = out[col].astype(dtype)
+    return out
+
+def engineer_features(df: pd.DataFrame, time_col: str, compact: bool = False) -> pd.DataFrame:
     dt = pd.to_datetime(df[time_col])
     df["hour"] = dt.dt.hour.astype("int16")
     df["dow"] = dt.dt.dayofweek.astype("int8")
@@ -34,22 +67,299 @@ def engineer_features(df: pd.DataFrame, time_col: str) -> pd.DataFrame:
 
     keep = ["ride_id","label_tip20", time_col, "hour","dow","month","year",
             "trip_distance","passenger_count","PULocationID","DOLocationID","payment_type","VendorID","RatecodeID"]
+    if compact:
+        return to_compact(df[keep])
     return df[keep]
 
-def partition_by_month(df: pd.DataFrame, time_col: str, out_dir: str):
+def partition_by_month(df: pd.DataFrame, time_col: str, out_dir: str, fmt: OutputFormat = OutputFormat()):
     df["_month"] = pd.to_datetime(df[time_col]).dt.to_period("M").astype(str)
     for m, sub in df.groupby("_month"):
         out_path = os.path.join(out_dir, f"table_{m}.parquet")
-        sub.drop(columns=["_month"]).to_parquet(out_path, index=False)
+        sub.drop(columns=["_month"]).to_parquet(out_path, index=False, row_group_size=fmt.row_group_size,
+                                                **fmt.writer_kwargs())
         print("Saved", out_path)
 
+_NULLABLE_UINTS = {pa.uint8(): pd.UInt8Dtype(), pa.uint16(): pd.UInt16Dtype()}
+
+def parse_filters(specs, schema: pa.Schema):
+    # [[col, op, value], ...] from YAML/CLI -> pyarrow filter tuples, with values cast
+    # to the column type (e.g. "2023-01-15" for a timestamp column, "1,2" for "in").
+    def cast(typ, v):
+        if pa.types.is_timestamp(typ) or pa.types.is_date(typ):
+            return pd.Timestamp(v)
+        if pa.types.is_integer(typ):
+            return int(v)
+        if pa.types.is_floating(typ):
+            return float(v)
+        return v
+    out = []
+    for col, op, val in specs or []:
+        typ = schema.field(col).type
+        if op in ("in", "not in"):
+            vals = val.split(",") if isinstance(val, str) else val
+            out.append((col, op, [cast(typ, v) for v in vals]))
+        else:
+            out.append((col, op, cast(typ, val)))
+    return out
+
+def read_processed(fp: str, columns=None, filters=None) -> pd.DataFrame:
+    # Compact columns that contain nulls come back as nullable pandas ints instead
+    # of being upcast to float64; everything else converts as usual. columns and
+    # filters are pushed down to the parquet reader, so unused columns and row
+    # groups ruled out by their statistics are never decoded.
+    filters = parse_filters(filters, pq.read_schema(fp)) if filters else None
+    return table_to_frame(pq.read_table(fp, columns=columns, filters=filters))
+
+def table_to_frame(table: pa.Table) -> pd.DataFrame:
+    return pd.DataFrame({name: col.to_pandas(types_mapper=_NULLABLE_UINTS.get if col.null_count else None)
+                         for name, col in zip(table.column_names, table.columns)})
+
+class _MonthWriter:
+    # ParquetWriter that buffers small appends into row groups of fmt.row_group_size rows.
+    def __init__(self, path: str, schema: pa.Schema, fmt: OutputFormat):
+        self.writer = pq.ParquetWriter(path, schema, **fmt.writer_kwargs())
+        self.schema = schema
+        self.row_group_size = fmt.row_group_size
+        self.buffer, self.buffered = [], 0
+
+    def write_table(self, table: pa.Table):
+        # raw files may disagree on e.g. timestamp unit; keep the first schema
+        table = table.cast(self.schema)
+        if not self.row_group_size:
+            self.writer.write_table(table)
+            return
+        self.buffer.append(table)
+        self.buffered += len(table)
+        if self.buffered >= self.row_group_size:
+            self.flush(final=False)
+
+    def flush(self, final: bool = True):
+        if not self.buffer:
+            return
+        table = pa.concat_tables(self.buffer)
+        n_full = len(table) - len(table) % self.row_group_size
+        cut = len(table) if final else n_full
+        if cut:
+            self.writer.write_table(table.slice(0, cut), row_group_size=self.row_group_size)
+        rest = table.slice(cut)
+        self.buffer, self.buffered = ([rest], len(rest)) if len(rest) else ([], 0)
+
+    def close(self):
+        if self.row_group_size:
+            self.flush()
+        self.writer.close()
+
+def _append_file(fp, time_col: str, batch_size: int, writers: dict, path_for, keep=None, fmt: OutputFormat = OutputFormat()):
+    # Append one raw file to per-month writers, batch by batch. Returns rows per month.
+    # If keep is given, rows of other months are dropped.
+    counts = {}
+    pf = pq.ParquetFile(fp)
+    for batch in pf.iter_batches(batch_size=batch_size):
+        ft = engineer_features(batch.to_pandas(), time_col, compact=fmt.compact)
+        months = pd.to_datetime(ft[time_col]).dt.to_period("M").astype(str)
+        for m, sub in ft.groupby(months, sort=False):
+            if keep is not None and m not in keep:
+                continue
+            table = pa.Table.from_pandas(sub, preserve_index=False)
+            if m not in writers:
+                os.makedirs(os.path.dirname(path_for(m)), exist_ok=True)
+                writers[m] = _MonthWriter(path_for(m), table.schema, fmt)
+            writers[m].write_table(table)
+            counts[m] = counts.get(m, 0) + len(sub)
+    return counts
+
+def _close_writers(writers: dict):
+    for m in sorted(writers):
+        writers[m].close()
+
+def select_files(files, min_rows: int = None):
+    # Same prefix of files the in-memory path reads, decided from parquet footers only.
+    out, total = [], 0
+    for fp in files:
+        out.append(fp)
+        total += pq.ParquetFile(fp).metadata.num_rows
+        if min_rows is not None and total >= min_rows:
+            break
+    return out
+
+def stream_partition_by_month(files, time_col: str, out_dir: str, batch_size: int = 1_000_000, min_rows: int = None,
+                              fmt: OutputFormat = OutputFormat()):
+    # Read each raw file batch by batch and append to per-month writers, so peak
+    # memory is bounded by batch_size instead of by the size of the dataset.
+    path_for = lambda m: os.path.join(out_dir, f"table_{m}.parquet")
+    writers = {}
+    total = 0
+    try:
+        for fp in files:
+            print("Streaming", fp)
+            total += sum(_append_file(fp, time_col, batch_size, writers, path_for, fmt=fmt).values())
+            if min_rows is not None and total >= min_rows:
+                break
+    finally:
+        _close_writers(writers)
+    for m in sorted(writers):
+        print("Saved", path_for(m))
+    print("Streamed rows:", total)
+    return total
+
+def _part_path(out_dir: str, idx: int, m: str) -> str:
+    return os.path.join(out_dir, "_parts", f"{idx:05d}", f"table_{m}.parquet")
+
+def _preprocess_file(idx: int, fp: str, time_col: str, out_dir: str, batch_size: int, keep=None,
+                     fmt: OutputFormat = OutputFormat()):
+    # Worker: raw file -> one part file per month it touches (its own month plus spill-over).
+    print("Streaming", fp)
+    writers = {}
+    try:
+        counts = _append_file(fp, time_col, batch_size, writers, lambda m: _part_path(out_dir, idx, m), keep, fmt)
+    finally:
+        _close_writers(writers)
+    return idx, counts
+
+def _merge_parts(parts, out_path: str, fmt: OutputFormat = OutputFormat()):
+    # Concatenate part files in raw-file order, one row group at a time.
+    if len(parts) == 1:
+        os.replace(parts[0], out_path)
+        return out_path
+    writer = None
+    try:
+        for p in parts:
+            pf = pq.ParquetFile(p)
+            for i in range(pf.num_row_groups):
+                table = pf.read_row_group(i)
+                if writer is None:
+                    writer = _MonthWriter(out_path, table.schema, fmt)
+                writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+    return out_path
+
+def _write_parts(ex, tasks, time_col: str, out_dir: str, batch_size: int, fmt: OutputFormat = OutputFormat()):
+    # tasks: [(idx, raw_path, keep_months or None)] -> {idx: {month: rows}}
+    futs = [ex.submit(_preprocess_file, idx, fp, time_col, out_dir, batch_size, keep, fmt) for idx, fp, keep in tasks]
+    return dict(fut.result() for fut in as_completed(futs))
+
+def _merge_months(ex, per_file: dict, out_dir: str, fmt: OutputFormat = OutputFormat()):
+    # Merge each month's parts in idx order, so the output is identical to the serial path.
+    month_parts = {}
+    for idx in sorted(per_file):
+        for m in per_file[idx]:
+            month_parts.setdefault(m, []).append(_part_path(out_dir, idx, m))
+    futs = [ex.submit(_merge_parts, parts, os.path.join(out_dir, f"table_{m}.parquet"), fmt)
+            for m, parts in sorted(month_parts.items())]
+    for fut in futs:
+        print("Saved", fut.result())
+    shutil.rmtree(os.path.join(out_dir, "_parts"), ignore_errors=True)
+    return sorted(month_parts)
+
+def parallel_partition_by_month(files, time_col: str, out_dir: str, batch_size: int = 1_000_000, jobs: int = None,
+                                fmt: OutputFormat = OutputFormat()):
+    # Fan raw files out to a process pool, then merge each month's parts in the same pool.
+    with ProcessPoolExecutor(max_workers=jobs) as ex:
+        per_file = _write_parts(ex, [(i, fp, None) for i, fp in enumerate(files)], time_col, out_dir, batch_size, fmt)
+        return _merge_months(ex, per_file, out_dir, fmt)
+
+MANIFEST_NAME = "_manifest.json"
+
+def feature_code_version() -> str:
+    # Any edit to the label/feature code, the compact dtypes or the month writer
+    # (all of which change the bytes written) invalidates every processed month.
+    src = "".join(inspect.getsource(f) for f in (compute_tip_rate, engineer_features, to_compact, _MonthWriter)) \
+        + repr(COMPACT_DTYPES)
+    return hashlib.sha256(src.encode()).hexdigest()[:16]
+
+def file_sha256(fp: str, chunk: int = 1 << 24) -> str:
+    h = hashlib.sha256()
+    with open(fp, "rb") as f:
+        for block in iter(lambda: f.read(chunk), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def load_manifest(out_dir: str) -> dict:
+    path = os.path.join(out_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+def save_manifest(out_dir: str, manifest: dict):
+    path = os.path.join(out_dir, MANIFEST_NAME)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+def incremental_partition_by_month(files, time_col: str, out_dir: str, batch_size: int = 1_000_000, jobs: int = None,
+                                   fmt: OutputFormat = OutputFormat()):
+    # Rebuild only the months whose raw inputs (size/mtime, then sha256) or feature
+    # code/args changed since the last run, as recorded in out_dir/_manifest.json.
+    key = {"feature_version": feature_code_version(), "args": {"time_col": time_col, **asdict(fmt)}}
+    old = load_manifest(out_dir)
+    old_files = old.get("files", {}) if all(old.get(k) == v for k, v in key.items()) else {}
+    if old and not old_files:
+        print("Feature code or args changed; rebuilding all months")
+
+    entries, dirty = {}, []
+    for idx, fp in enumerate(files):
+        name = os.path.basename(fp)
+        st = os.stat(fp)
+        prev = old_files.get(name)
+        if prev and prev["size"] == st.st_size and prev["mtime"] == st.st_mtime:
+            sha = prev["sha256"]
+        else:
+            sha = file_sha256(fp)
+        entries[name] = {"size": st.st_size, "mtime": st.st_mtime, "sha256": sha,
+                         "months": prev["months"] if prev and prev["sha256"] == sha else None}
+        if entries[name]["months"] is None:
+            dirty.append(idx)
+
+    removed = [n for n in old_files if n not in entries]
+    existing = {os.path.basename(p)[len("table_"):-len(".parquet")] for p in glob.glob(os.path.join(out_dir, "table_*.parquet"))}
+    affected = {m for n in removed for m in old_files[n]["months"]}
+    affected |= {m for idx in dirty if os.path.basename(files[idx]) in old_files
+                 for m in old_files[os.path.basename(files[idx])]["months"]}
+    affected |= {m for e in entries.values() if e["months"] for m in e["months"] if m not in existing}
+    if not dirty and not affected:
+        save_manifest(out_dir, {**key, "files": entries})
+        print("Processed months are up to date")
+        return []
+
+    # New/changed raw files are processed in full; unchanged files that also
+    # contribute to an affected month are re-read for those months only.
+    with ProcessPoolExecutor(max_workers=jobs) as ex:
+        per_file = _write_parts(ex, [(idx, files[idx], None) for idx in dirty], time_col, out_dir, batch_size, fmt)
+        for idx, counts in per_file.items():
+            entries[os.path.basename(files[idx])]["months"] = counts
+            affected |= set(counts)
+        tasks = [(idx, fp, affected) for idx, fp in enumerate(files)
+                 if idx not in per_file and affected & set(entries[os.path.basename(fp)]["months"])]
+        per_file.update(_write_parts(ex, tasks, time_col, out_dir, batch_size, fmt))
+        for m in affected:
+            out_path = os.path.join(out_dir, f"table_{m}.parquet")
+            if os.path.exists(out_path):
+                os.remove(out_path)
+        _merge_months(ex, per_file, out_dir, fmt)
+
+    save_manifest(out_dir, {**key, "files": entries})
+    print("Rebuilt months:", sorted(affected))
+    return sorted(affected)
+
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--raw_dir", type=str, required=True)
     ap.add_argument("--out_dir", type=str, required=True)
     ap.add_argument("--time_col", type=str, required=True)
     ap.add_argument("--min_rows", type=int, default=1_000_000)
+    ap.add_argument("--stream", action="store_true", help="process raw files in record batches with bounded memory")
+    ap.add_argument("--batch_size", type=int, default=1_000_000, help="rows per record batch in --stream/--jobs mode")
+    ap.add_argument("--incremental", action="store_true", help="only rebuild months whose raw inputs or feature code changed (see _manifest.json)")
+    ap.add_argument("--jobs", type=int, default=1, help="worker processes; >1 (or <1 for all cores) preprocesses raw files in parallel")
+    ap.add_argument("--compact", action="store_true", help="store calendar parts and categoricals as small unsigned ints")
+    ap.add_argument("--compression", type=str, default="snappy", help="parquet codec, e.g. snappy, zstd, lz4, none")
+    ap.add_argument("--compression_level", type=int, default=None, help="codec level, e.g. 1-22 for zstd")
+    ap.add_argument("--row_group_size", type=int, default=None, help="rows per parquet row group (default: writer default)")
     args = ap.parse_args()
+    fmt = OutputFormat(args.compact, args.compression, args.compression_level, args.row_group_size)
 
     os.makedirs(args.out_dir, exist_ok=True)
 
@@ -58,6 +368,22 @@ def main():
     if not files:
         raise SystemExit(f"No parquet files found in {args.raw_dir}")
 
+    if args.incremental:
+        files = select_files(files, args.min_rows)
+        incremental_partition_by_month(files, args.time_col, args.out_dir, args.batch_size,
+                                       None if args.jobs < 1 else args.jobs, fmt)
+        return
+
+    if args.jobs != 1:
+        files = select_files(files, args.min_rows)
+        parallel_partition_by_month(files, args.time_col, args.out_dir, args.batch_size,
+                                    None if args.jobs < 1 else args.jobs, fmt)
+        return
+
+    if args.stream:
+        stream_partition_by_month(files, args.time_col, args.out_dir, args.batch_size, args.min_rows, fmt)
+        return
+
     dfs = []
     total = 0
     for fp in files:
@@ -72,10 +398,10 @@ def main():
     print("Loaded rows:", len(full))
 
     # Feature engineering
-    ft = engineer_features(full, args.time_col)
+    ft = engineer_features(full, args.time_col, compact=args.compact)
 
     # Partition by month for time splits
-    partition_by_month(ft, args.time_col, args.out_dir)
+    partition_by_month(ft, args.time_col, args.out_dir, fmt)
 
 if __name__ == "__main__":
     main()
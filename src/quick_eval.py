@@ -0,0 +1,109 @@
+import os, numpy as np, pandas as pd
+import pyarrow as pa, pyarrow.parquet as pq
+from .bootstrap import bootstrap, percentile_ci
+from .preprocess import parse_filters, table_to_frame
+from .feature_cache import FeatureCache
+
+# Sequential-sampling estimates for smoke checks: rows are drawn stratified by
+# (month, label) with proportional allocation, so the sample is self-weighting,
+# and the sample grows until the bootstrap CI half-width of every requested
+# metric (with finite-population correction) is below the target. Each round only
+# scores the rows it adds. Repeated looks make the achieved half-widths slightly
+# optimistic; they are reported next to the estimates.
+
+QUICK_METRICS = ("roc_auc", "pr_auc", "brier", "ece")
+
+class TestRows:
+    # Test rows (after filters) in load_splits order from one pass over the label and
+    # filter columns: label, (month, label) stratum and file position per row.
+    # Features are then read for sampled rows only, one parquet row group (or, with a
+    # FeatureCache, the mapped pages holding them) at a time.
+    def __init__(self, processed_dir, months, label_col, filters=None, cache_dir=None):
+        self.files = [os.path.join(processed_dir, f"table_{m}.parquet") for m in months]
+        self.months, self.label_col = list(months), label_col
+        self.cache = FeatureCache(cache_dir, processed_dir, label_col) if cache_dir else None
+        ys, pos, month = [], [], []
+        for i, fp in enumerate(self.files):
+            t = pq.read_table(fp, columns=list(dict.fromkeys([label_col] + [f[0] for f in filters or []])))
+            t = t.append_column("__row", pa.array(np.arange(t.num_rows)))
+            if filters:
+                t = t.filter(pq.filters_to_expression(parse_filters(filters, pq.read_schema(fp))))
+            ys.append(t.column(label_col).to_numpy().astype(np.int64))
+            pos.append(t.column("__row").to_numpy())
+            month.append(np.full(t.num_rows, i))
+        self.y, self.pos, self.month = np.concatenate(ys), np.concatenate(pos), np.concatenate(month)
+        self.strata = self.month * 2 + self.y
+
+    def _take(self, i, pos) -> pa.Table:
+        # rows at sorted file positions pos of month i
+        if self.cache:
+            return self.cache.table(self.months[i]).take(pos)
+        pf = pq.ParquetFile(self.files[i])
+        starts = np.cumsum([0] + [pf.metadata.row_group(g).num_rows for g in range(pf.num_row_groups)])
+        g = np.searchsorted(starts, pos, side="right") - 1
+        return pa.concat_tables([pf.read_row_group(k).take(pos[g == k] - starts[k]) for k in np.unique(g)])
+
+    def features(self, idx) -> pd.DataFrame:
+        # X for rows idx, in idx order
+        idx = np.asarray(idx)
+        frames, rows = [], []
+        for i in np.unique(self.month[idx]):
+            sel = idx[self.month[idx] == i]
+            sel = sel[np.argsort(self.pos[sel], kind="stable")]
+            frames.append(table_to_frame(self._take(i, self.pos[sel])))
+            rows.append(sel)
+        X = pd.concat(frames, ignore_index=True).drop(columns=[self.label_col])
+        order = np.empty(len(idx), dtype=np.int64)
+        order[np.argsort(idx, kind="stable")] = np.argsort(np.concatenate(rows), kind="stable")
+        return X.iloc[order].reset_index(drop=True)
+
+class StratifiedSample:
+    # nested stratified samples: every larger sample contains the smaller ones
+    def __init__(self, strata, seed=0):
+        _, codes, self.sizes = np.unique(strata, return_inverse=True, return_counts=True)
+        rng = np.random.default_rng(seed)
+        order = np.argsort(codes, kind="stable")
+        self.perms = [rng.permutation(rows) for rows in np.split(order, np.cumsum(self.sizes)[:-1])]
+        self.total = int(self.sizes.sum())
+        self.taken = np.zeros(len(self.sizes), dtype=np.int64)
+
+    def grow(self, n):
+        # -> indices of rows added to reach (at least) n; quotas round up, so they never shrink
+        quota = np.minimum(np.ceil(n * self.sizes / self.total).astype(np.int64), self.sizes)
+        new = [perm[a:b] for perm, a, b in zip(self.perms, self.taken, np.maximum(quota, self.taken))]
+        self.taken = np.maximum(quota, self.taken)
+        return np.concatenate(new)
+
+def fpc_ci(y, p, which, total, n_boot=200, seed=0, jobs=1, n_bins=15, alpha=0.05):
+    # {metric: [lo, hi]} from a label-stratified bootstrap of a sample of `total`
+    # rows; replicates are pulled toward their mean by the finite-population correction
+    reps = bootstrap(y, p, n_boot=n_boot, seed=seed, jobs=jobs, which=tuple(which), n_bins=n_bins, stratified=True)
+    fpc = np.sqrt(max(0.0, 1.0 - len(y) / total))
+    return percentile_ci({k: np.nanmean(r) + (r - np.nanmean(r)) * fpc for k, r in reps.items()}, alpha)
+
+def half_widths(y, p, which, total, n_boot=200, seed=0, jobs=1, n_bins=15):
+    return {k: (hi - lo) / 2 for k, (lo, hi) in fpc_ci(y, p, which, total, n_boot, seed, jobs, n_bins).items()}
+
+def sequential_sample(strata, y, score, precision, which=QUICK_METRICS, start=20000, max_growth=4.0,
+                      n_boot=200, seed=0, jobs=1, n_bins=15):
+    # score(idx) -> {name: scores of rows idx}. Grows the sample until every name
+    # meets `precision` (half-width; float or {metric: half-width}) on every metric
+    # in `which`, or all rows are in. -> (idx, {name: scores}, {name: {metric:
+    # half-width}}, rounds)
+    y = np.asarray(y)
+    target = precision if isinstance(precision, dict) else {k: precision for k in which}
+    sample = StratifiedSample(strata, seed)
+    idx, preds, n, rounds = np.empty(0, dtype=np.int64), {}, start, 0
+    while True:
+        new = sample.grow(n)
+        for name, p in score(new).items():
+            preds[name] = np.r_[preds.get(name, np.empty(0)), p]
+        idx = np.r_[idx, new]
+        rounds += 1
+        hw = {name: half_widths(y[idx], p, target, sample.total, n_boot, seed, jobs, n_bins) for name, p in preds.items()}
+        # worst ratio of achieved to target half-width; width shrinks ~ 1/sqrt(n)
+        ratio = max(hw[name][k] / target[k] for name in hw for k in target)
+        print(f"[quick] round {rounds}: {len(idx)}/{sample.total} rows, worst half-width / target = {ratio:.2f}")
+        if ratio <= 1.0 or len(idx) >= sample.total:
+            return idx, preds, hw, rounds
+        n = int(min(len(idx) * max_growth, len(idx) * ratio ** 2 * 1.1, sample.total))
@@ -1,22 +1,302 @@
-import argparse, os, json, pandas as pd, numpy as np, yaml
-from joblib import dump
+import argparse, os, json, time, pandas as pd, numpy as np, yaml
+from joblib import dump, load, hash as joblib_hash
+from sklearn.pipeline import Pipeline
 from sklearn.metrics import roc_auc_score, average_precision_score, brier_score_loss
 from sklearn.linear_model import LogisticRegression
 from xgboost import XGBClassifier
 from catboost import CatBoostClassifier
 from .train import load_splits, infer_feature_types
-from .models import make_logreg, make_xgb, make_catboost
+from .models import make_logreg, make_xgb, make_catboost, EXPECTED_COST
+from .evaluate import summarize_mean_std
+from .external_memory import ExternalTrainer, month_files, schema_frame, predict_files
+from .month_store import MonthStore, PeriodStore, backtest_periods
+from .scheduler import run_parallel, set_estimator_threads
+from .cost_sweep import Sweep, threshold_costs, optimal_threshold, json_threshold
+from .segments import sliced_metrics
+from .preprocess import read_processed
 
 def month_sort(months):
     return sorted(months)
 
+def window_metrics(p_va, yva, p_te, yte, ccfg):
+    # select threshold on valid by expected cost (configured grid; TP/TN costs not counted)
+    fp_fn = {"c_fp": ccfg["c_fp"], "c_fn": ccfg["c_fn"]}
+    sweep = Sweep(yva, p_va)
+    best_th = ccfg["thresholds"][int(np.argmin(threshold_costs(yva, p_va, ccfg["thresholds"], fp_fn, sweep=sweep)))]
+    # and the exact optimum over all valid scores
+    opt_th, _ = optimal_threshold(yva, p_va, fp_fn, sweep=sweep)
+
+    # metrics on test
+    roc = roc_auc_score(yte, p_te)
+    pr = average_precision_score(yte, p_te)
+    brier = brier_score_loss(yte, p_te)
+    exp_cost, opt_cost = threshold_costs(yte, p_te, [best_th, opt_th], fp_fn)
+    return {"roc_auc": float(roc), "pr_auc": float(pr), "brier": float(brier), "best_th": float(best_th),
+            "expected_cost": float(exp_cost), "opt_th": json_threshold(opt_th), "expected_cost_opt": float(opt_cost)}
+
+def warm_fit(prev, Xtr, ytr, rounds):
+    # Continue boosting a fitted Pipeline for `rounds` new trees on (Xtr, ytr). The
+    # preprocessor stays as fitted on the first window, since the existing trees
+    # were grown on its feature space.
+    pre, old = prev[:-1], prev[-1]
+    Z = pre.transform(Xtr)
+    if isinstance(old, XGBClassifier):
+        clf = XGBClassifier(**{**old.get_params(), "n_estimators": rounds})
+        clf.fit(Z, ytr, xgb_model=old.get_booster())
+    else:
+        clf = CatBoostClassifier(**{**old.get_params(), "iterations": rounds})
+        clf.fit(Z, ytr, init_model=old)
+    return Pipeline(pre.steps + [(prev.steps[-1][0], clf)])
+
+def make_factory(cfg, model):
+    # model name -> factory(num_cols, cat_cols)
+    mcfg = cfg["models"]
+    native = cfg.get("training", {}).get("tree_native", False)
+    if model == "logreg":
+        return lambda num, cat: make_logreg(num, cat, C=mcfg["logistic_regression"]["C"], max_iter=mcfg["logistic_regression"]["max_iter"])
+    elif model == "xgb":
+        return lambda num, cat: make_xgb(num, cat, mcfg["xgboost"], native=native)
+    return lambda num, cat: make_catboost(num, cat, mcfg["catboost"], native=native)
+
+# per-process backtest state: cfg, args, months and the MonthStore
+_R = {}
+
+def init_backtest(threads, cfg, args, months, periods=None):
+    # months: period labels (months unless --step week/day); periods: backtest_periods()
+    dcfg = cfg["data"]
+    _R.update(cfg=cfg, args=args, months=months, periods=periods, threads=threads)
+    if "store" not in _R and not args.external_memory:
+        if args.step == "month" and args.window == "expanding":
+            _R["store"] = MonthStore.load(dcfg["processed_dir"], months, dcfg["label_col"],
+                                          cache_dir=dcfg.get("feature_cache_dir"))
+        else:
+            # ring buffer: a sliding window needs train + valid + test periods
+            _R["store"] = PeriodStore(dcfg["processed_dir"], dcfg["label_col"], dcfg["time_col"], periods,
+                                      args.train_periods + 2 if args.window == "sliding" else None,
+                                      cache_dir=dcfg.get("feature_cache_dir"))
+
+def split_months(months, i, train_periods=None):
+    # window i -> (train months, valid month, test month); train_periods: sliding
+    # window length (None: expanding from the first month)
+    train_months = months[:i]      # up to i-1
+    # use last month of train as valid for threshold selection
+    valid_month = train_months[-1]
+    train_months = (train_months[:-1] if len(train_months) > 1 else train_months)
+    if train_periods:
+        train_months = train_months[-train_periods:]
+    return train_months, valid_month, months[i]
+
+# Grid cells (model, seed, window) are persisted as JSON when finished and skipped
+# on restart while their key (config, model, seed, window months and the size and
+# mtime of their files, run options) is unchanged. Warm-start chains also keep the latest window's model for resuming.
+
+def sliding_periods(args):
+    return args.train_periods if args.window == "sliding" else None
+
+def period_unit(args):
+    # row columns are test_/valid_<unit>
+    return "month" if args.step == "month" else "period"
+
+def cell_path(model, seed, i, ext="json"):
+    return os.path.join(_R["args"].cells_dir, f"{model}_seed{seed}_{_R['months'][i]}.{ext}")
+
+def cell_key(cfg, args, periods, model, seed, i):
+    # periods: backtest_periods(); window i reads the files of periods[:i + 1]
+    labels = list(periods)[:i + 1]
+    files = sorted({m for p in labels for m in periods[p][0]})
+    stats = [os.stat(os.path.join(cfg["data"]["processed_dir"], f"table_{m}.parquet")) for m in files]
+    data = [(m, st.st_size, st.st_mtime_ns) for m, st in zip(files, stats)]
+    opts = {k: getattr(args, k) for k in ("external_memory", "warm_start", "warm_rounds", "warm_data", "compare_full",
+                                          "window", "train_periods", "step")}
+    if args.segment_by:
+        opts["segment_by"] = args.segment_by
+    return joblib_hash((cfg, model, seed, labels, data, opts))
+
+def load_cell(model, seed, i):
+    path = cell_path(model, seed, i)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        cell = json.load(f)
+    return cell["row"] if cell["key"] == cell_key(_R["cfg"], _R["args"], _R["periods"], model, seed, i) else None
+
+def save_cell(model, seed, i, row):
+    path = cell_path(model, seed, i)
+    tmp = f"{path}.tmp{os.getpid()}"
+    with open(tmp, "w") as f:
+        json.dump({"key": cell_key(_R["cfg"], _R["args"], _R["periods"], model, seed, i), "row": row}, f, indent=2)
+    os.replace(tmp, path)
+
+def run_cell(model, seed, i):
+    row = run_window(i, model, seed)[0]
+    save_cell(model, seed, i, row)
+    return {i: row}
+
+def run_chain(model, seed, windows):
+    # warm start: window i continues window i-1's model, so a chain runs in order,
+    # resuming after the newest finished window whose model was kept (never with --fresh)
+    rows, start, prev, prev_months = {}, 0, None, []
+    for k in ([] if _R["args"].fresh else range(len(windows) - 1, -1, -1)):
+        path = cell_path(model, seed, windows[k], "joblib")
+        done = [load_cell(model, seed, i) for i in windows[:k + 1]]
+        if os.path.exists(path) and all(r is not None for r in done):
+            rows, start = dict(zip(windows, done)), k + 1
+            prev, prev_months = load(path), split_months(_R["months"], windows[k], sliding_periods(_R["args"]))[0]
+            break
+    for k in range(start, len(windows)):
+        i = windows[k]
+        row, prev, prev_months = run_window(i, model, seed, prev, prev_months)
+        dump(prev, cell_path(model, seed, i, "joblib"))
+        save_cell(model, seed, i, row)
+        if k:
+            # only the newest model is needed to resume
+            old = cell_path(model, seed, windows[k - 1], "joblib")
+            if os.path.exists(old):
+                os.remove(old)
+        rows[i] = row
+    return rows
+
+def write_outputs(rows, cells, base):
+    # rows: {(model, seed, i): row}; one model and seed -> the plain per-window csv,
+    # otherwise every cell (<base>_grid.csv) plus mean±std over seeds per window
+    done = [c for c in cells if c in rows]
+    if len({c[:2] for c in cells}) == 1:
+        pd.DataFrame([rows[c] for c in done]).to_csv(f"reports/rolling/{base}.csv", index=False)
+        return
+    grid = pd.DataFrame([{"model": c[0], "seed": c[1], **rows[c]} for c in done])
+    grid.to_csv(f"reports/rolling/{base}_grid.csv", index=False)
+    unit = period_unit(_R["args"])
+    test_col, valid_col = f"test_{unit}", f"valid_{unit}"
+    metric_cols = [c for c in grid.columns if c not in ("model", "seed", test_col, valid_col, "n_test")]
+    agg = []
+    for (model, test_month), g in grid.groupby(["model", test_col], sort=False):
+        summ = summarize_mean_std([{model: r} for r in g[metric_cols].to_dict("records")])[model]
+        agg.append({"model": model, test_col: test_month, valid_col: g[valid_col].iloc[0],
+                    "n_test": int(g["n_test"].iloc[0]), "n_seeds": len(g),
+                    **{f"{k}_{s}": v[s] for k, v in summ.items() for s in ("mean", "std")}})
+    pd.DataFrame(agg).to_csv(f"reports/rolling/{base}_mean_std.csv", index=False)
+
+def run_window(i, model, seed, prev=None, prev_months=()):
+    # Expanding window i: train on months[:i-1], pick the threshold on months[i-1],
+    # test on months[i]. Returns (metrics row, fitted model, train months).
+    cfg, args, months = _R["cfg"], _R["args"], _R["months"]
+    dcfg, mcfg, ccfg = cfg["data"], cfg["models"], cfg["costs"]
+    categorical = cfg.get("features", {}).get("categorical") or ()
+    factory = make_factory(cfg, model)
+
+    train_months_wo_valid, valid_month, test_month = split_months(months, i, sliding_periods(args))
+
+    if args.external_memory:
+        files = month_files(dcfg["processed_dir"], train_months_wo_valid)
+        num_cols, cat_cols = infer_feature_types(schema_frame(files[0]), dcfg["label_col"], dcfg["time_col"], categorical)
+        trainer = ExternalTrainer(files, dcfg["label_col"], num_cols, cat_cols,
+                                  mcfg["xgboost"].get("max_bin") or 256, args.batch_rows)
+        try:
+            mdl = trainer.fit(mcfg["xgboost"], seed)
+        finally:
+            trainer.close()
+        set_estimator_threads(mdl[-1], _R["threads"])
+        p_va, yva = predict_files(mdl, month_files(dcfg["processed_dir"], [valid_month]), dcfg["label_col"], args.batch_rows)
+        p_te, yte = predict_files(mdl, month_files(dcfg["processed_dir"], [test_month]), dcfg["label_col"], args.batch_rows)
+    else:
+        store = _R["store"]
+        Xtr, ytr = store.window(train_months_wo_valid)
+        Xva, yva = store.window([valid_month])
+        Xte, yte = store.window([test_month])
+
+        num_cols, cat_cols = infer_feature_types(Xtr, dcfg["label_col"], dcfg["time_col"], categorical)
+        full = None
+        if args.warm_start and prev is not None:
+            t0 = time.perf_counter()
+            rounds = args.warm_rounds or max(1, (mcfg["xgboost"].get("n_estimators", 100) if model == "xgb"
+                                                 else mcfg["catboost"].get("iterations", 1000)) // 4)
+            new = [m for m in train_months_wo_valid if m not in prev_months]
+            if args.warm_data == "new" and new:
+                Xn, yn = store.window(new)
+                mdl = warm_fit(prev, Xn, yn, rounds)
+            else:
+                mdl = warm_fit(prev, Xtr, ytr, rounds)
+            fit_s = time.perf_counter() - t0
+            if args.compare_full:
+                t0 = time.perf_counter()
+                full = factory(num_cols, cat_cols)
+                if hasattr(full[-1], "random_state"):
+                    full[-1].set_params(random_state=seed)
+                set_estimator_threads(full[-1], _R["threads"])
+                full.fit(Xtr, ytr)
+                full_s = time.perf_counter() - t0
+        else:
+            t0 = time.perf_counter()
+            mdl = factory(num_cols, cat_cols)
+            if hasattr(mdl[-1], "random_state"):
+                mdl[-1].set_params(random_state=seed)
+            set_estimator_threads(mdl[-1], _R["threads"])
+            mdl.fit(Xtr, ytr)
+            fit_s = full_s = time.perf_counter() - t0
+
+        p_va = mdl.predict_proba(Xva)[:,1]
+        p_te = mdl.predict_proba(Xte)[:,1]
+
+    unit = period_unit(args)
+    wm = window_metrics(p_va, yva, p_te, yte, ccfg)
+    row = {f"test_{unit}": test_month, f"valid_{unit}": valid_month, **wm, "n_test": int(len(yte))}
+    if args.warm_start:
+        row["fit_s"] = fit_s
+        if args.compare_full:
+            # no full refit (first window): the warm model is the full one, deltas are zero
+            ref = window_metrics(full.predict_proba(Xva)[:,1], yva, full.predict_proba(Xte)[:,1], yte, ccfg) \
+                if full is not None else wm
+            for k, v in ref.items():
+                # None: an opt_th of "predict no positives" on either side
+                row[f"delta_{k}"] = row[k] - v if v is not None and row[k] is not None else None
+            row["fit_s_full"] = full_s if full is not None else fit_s
+    if args.segment_by:
+        # per-segment test metrics at the valid-chosen threshold, kept next to the cell
+        cols = list(dict.fromkeys(c for by in args.segment_by for c in by))
+        keys = read_processed(month_files(dcfg["processed_dir"], [test_month])[0], columns=cols) \
+            if args.external_memory else Xte[cols]
+        seg = sliced_metrics(keys, args.segment_by, yte, p_te, {"c_fp": ccfg["c_fp"], "c_fn": ccfg["c_fn"]},
+                             row["best_th"], min_rows=args.min_segment_rows)
+        seg.insert(0, f"test_{unit}", test_month)
+        seg.insert(0, "seed", seed)
+        seg.insert(0, "model", model)
+        seg.to_parquet(cell_path(model, seed, i, "segments.parquet"), index=False)
+    return row, mdl, train_months_wo_valid
+
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--cfg", type=str, required=True)
-    ap.add_argument("--model", type=str, default="xgb", choices=["logreg","xgb","cat"])
-    ap.add_argument("--min_train_months", type=int, default=3)
-    ap.add_argument("--seed", type=int, default=42)
+    ap.add_argument("--model", type=str, nargs="+", default=["xgb"], choices=["logreg","xgb","cat"])
+    ap.add_argument("--min_train_months", type=int, default=3, help="first test period index (periods with --step week/day)")
+    ap.add_argument("--window", type=str, default="expanding", choices=["expanding","sliding"])
+    ap.add_argument("--train_periods", type=int, default=3, help="train length of a sliding window, in steps")
+    ap.add_argument("--step", type=str, default="month", choices=["month","week","day"],
+                    help="window step; weeks/days are read from the month files with time-column filters")
+    ap.add_argument("--seed", type=int, nargs="+", default=[42])
+    ap.add_argument("--cells_dir", type=str, default="reports/rolling/cells",
+                    help="finished (model, seed, window) cells; completed cells are skipped on restart")
+    ap.add_argument("--fresh", action="store_true", help="recompute all cells")
+    ap.add_argument("--external_memory", action="store_true", help="xgb only: train each window out-of-core")
+    ap.add_argument("--batch_rows", type=int, default=1_000_000, help="rows per streamed batch with --external_memory")
+    ap.add_argument("--warm_start", action="store_true",
+                    help="xgb/cat: continue boosting the previous window's model instead of refitting")
+    ap.add_argument("--warm_rounds", type=int, default=None,
+                    help="new rounds per warm-started window (default: a quarter of the configured rounds)")
+    ap.add_argument("--warm_data", type=str, default="window", choices=["window","new"],
+                    help="warm-start on the whole train window or only the month(s) added since the last window")
+    ap.add_argument("--compare_full", action="store_true", help="with --warm_start, also refit from scratch and report deltas")
+    ap.add_argument("--segment_by", nargs="+", action="append", default=[], metavar="COL",
+                    help="per-segment test metrics, e.g. --segment_by PULocationID hour --segment_by payment_type")
+    ap.add_argument("--min_segment_rows", type=int, default=1)
+    ap.add_argument("--jobs", type=int, default=1, help="cells run concurrently (warm start: one chain per model x seed); -1 = one per core")
+    ap.add_argument("--threads", type=int, default=None, help="total core budget split between the --jobs workers")
     args = ap.parse_args()
+    if args.external_memory and set(args.model) != {"xgb"}:
+        ap.error("--external_memory requires --model xgb")
+    if args.external_memory and args.step != "month":
+        ap.error("--external_memory requires --step month")
+    if args.warm_start and ("logreg" in args.model or args.external_memory):
+        ap.error("--warm_start requires --model xgb or cat (in memory)")
 
     with open(args.cfg,"r") as f:
         cfg = yaml.safe_load(f)
@@ -28,63 +308,52 @@ def main():
         if fn.startswith("table_") and fn.endswith(".parquet"):
             months.append(fn.split("table_")[1].split(".parquet")[0])
     months = month_sort(months)
+    periods = backtest_periods(dcfg["processed_dir"], months, dcfg["time_col"], args.step)
+    months = list(periods)
 
-    # choose model factory
-    if args.model == "logreg":
-        factory = lambda num, cat: make_logreg(num, cat, C=mcfg["logistic_regression"]["C"], max_iter=mcfg["logistic_regression"]["max_iter"])
-    elif args.model == "xgb":
-        factory = lambda num, cat: make_xgb(num, cat, mcfg["xgboost"])
-    else:
-        factory = lambda num, cat: make_catboost(num, cat, mcfg["catboost"])
-
-    rows = []
-    for i in range(args.min_train_months, len(months)):
-        train_months = months[:i]      # up to i-1
-        test_month = months[i]         # month i
-        # use last month of train as valid for threshold selection
-        valid_month = train_months[-1]
-        train_months_wo_valid = train_months[:-1] if len(train_months) > 1 else train_months
-
-        Xtr, ytr = load_splits(dcfg["processed_dir"], train_months_wo_valid, dcfg["label_col"])
-        Xva, yva = load_splits(dcfg["processed_dir"], [valid_month], dcfg["label_col"])
-        Xte, yte = load_splits(dcfg["processed_dir"], [test_month], dcfg["label_col"])
-
-        num_cols, cat_cols = infer_feature_types(Xtr, dcfg["label_col"], dcfg["time_col"])
-        mdl = factory(num_cols, cat_cols)
-        if hasattr(mdl[-1], "random_state"):
-            mdl[-1].set_params(random_state=args.seed)
-        mdl.fit(Xtr, ytr)
-
-        p_va = mdl.predict_proba(Xva)[:,1]
-        p_te = mdl.predict_proba(Xte)[:,1]
+    os.makedirs("reports/rolling", exist_ok=True)
+    os.makedirs(args.cells_dir, exist_ok=True)
+    base = "metrics_warm" if args.warm_start else "metrics"
+    first = max(args.min_train_months, args.train_periods + 1) if args.window == "sliding" else args.min_train_months
+    windows = list(range(first, len(months)))
+    cells = [(m, s, i) for m in args.model for s in args.seed for i in windows]
+    _R.update(cfg=cfg, args=args, months=months, periods=periods)
+    rows = {} if args.fresh else {c: r for c in cells for r in [load_cell(*c)] if r is not None}
+    todo = [c for c in cells if c not in rows]
+    if rows:
+        print(f"[grid] {len(rows)}/{len(cells)} cells already done in {args.cells_dir}")
 
-        # select threshold on valid by expected cost
-        best_th, min_cost = None, float("inf")
-        for th in cfg["costs"]["thresholds"]:
-            ypred = (p_va >= th).astype(int)
-            fp = ((ypred==1) & (yva==0)).sum()
-            fn = ((ypred==0) & (yva==1)).sum()
-            cost = cfg["costs"]["c_fp"]*fp + cfg["costs"]["c_fn"]*fn + cfg["costs"]["c_tp"]*0 + cfg["costs"]["c_tn"]*0
-            if cost < min_cost:
-                min_cost, best_th = cost, th
-
-        # metrics on test
-        roc = roc_auc_score(yte, p_te)
-        pr = average_precision_score(yte, p_te)
-        brier = brier_score_loss(yte, p_te)
-        ypred_te = (p_te >= best_th).astype(int)
-        fp = int(((ypred_te==1) & (yte==0)).sum())
-        fn = int(((ypred_te==0) & (yte==1)).sum())
-        exp_cost = cfg["costs"]["c_fp"]*fp + cfg["costs"]["c_fn"]*fn
-
-        rows.append({"test_month": test_month, "valid_month": valid_month, "roc_auc": float(roc), "pr_auc": float(pr),
-                     "brier": float(brier), "best_th": float(best_th), "expected_cost": float(exp_cost),
-                     "n_test": int(len(yte))})
+    def done(task, result):
+        # rewrite the outputs as cells finish
+        for i, row in result.items():
+            rows[(task[0], task[1], i)] = row
+        write_outputs(rows, cells, base)
 
-    os.makedirs("reports/rolling", exist_ok=True)
-    out_csv = "reports/rolling/metrics.csv"
-    pd.DataFrame(rows).to_csv(out_csv, index=False)
-    print(f"Saved rolling metrics -> {out_csv}")
+    if todo:
+        # loaded here so forked workers share the store instead of each reading it
+        init_backtest(None, cfg, args, months, periods)
+        if args.warm_start:
+            # each window continues the previous one's model: one sequential chain per (model, seed)
+            chains = list(dict.fromkeys(c[:2] for c in todo))
+            run_parallel(run_chain, [(m, s, windows) for m, s in chains], jobs=args.jobs, threads=args.threads,
+                         initializer=init_backtest, initargs=(cfg, args, months, periods),
+                         cost=lambda t: EXPECTED_COST.get(t[0], 1.0), on_result=done)
+        else:
+            run_parallel(run_cell, todo, jobs=args.jobs, threads=args.threads,
+                         initializer=init_backtest, initargs=(cfg, args, months, periods),
+                         cost=lambda t: EXPECTED_COST.get(t[0], 1.0) * len(split_months(months, t[2], sliding_periods(args))[0]),
+                         on_result=done)
+    write_outputs(rows, cells, base)
+    print(f"Saved rolling metrics -> reports/rolling/{base}*.csv")
+    if args.segment_by:
+        segs = [cell_path(*c, "segments.parquet") for c in cells]
+        pd.concat([pd.read_parquet(f) for f in segs if os.path.exists(f)], ignore_index=True) \
+            .to_parquet(f"reports/rolling/{base}_segments.parquet", index=False)
+        print(f"Saved segment metrics -> reports/rolling/{base}_segments.parquet")
+    if args.warm_start and args.compare_full:
+        df = pd.DataFrame([rows[c] for c in cells])
+        print(f"warm-start fit {df.fit_s.sum():.1f}s vs full refits {df.fit_s_full.sum():.1f}s; "
+              f"mean delta roc_auc {df.delta_roc_auc.mean():+.4f}, expected_cost {df.delta_expected_cost.mean():+.1f}")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,82 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from threadpoolctl import threadpool_limits
+from catboost import CatBoost
+
+# Runs independent fits (seeds x models) in a process pool while splitting one
+# core budget between the workers: each worker gets total // workers threads for
+# its estimator (n_jobs / thread_count) and for BLAS/OpenMP, so the threads of
+# all workers together never exceed the machine.
+
+THREAD_ENV = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS",
+              "VECLIB_MAXIMUM_THREADS", "NUMEXPR_NUM_THREADS")
+
+def cpu_budget(total: int = None) -> int:
+    # cores this process may use (respects taskset / cgroup cpusets)
+    if total and total > 0:
+        return total
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def split_budget(n_tasks: int, jobs: int = 1, total: int = None):
+    # -> (workers, threads per worker); jobs=-1 means as many workers as cores
+    total = cpu_budget(total)
+    jobs = total if jobs is None or jobs < 1 else jobs
+    workers = max(1, min(n_tasks, jobs, total))
+    return workers, max(1, total // workers)
+
+def limit_threads(n: int):
+    # env for runtimes started later in this process, threadpoolctl for loaded ones
+    for k in THREAD_ENV:
+        os.environ[k] = str(n)
+    threadpool_limits(n)
+
+def set_estimator_threads(est, n: int):
+    if n is None:
+        return est
+    if hasattr(est, "n_jobs"):                      # sklearn, XGBoost
+        est.set_params(n_jobs=n)
+    elif isinstance(est, CatBoost):
+        est.set_params(thread_count=n)
+    return est
+
+def _init(threads, initializer, initargs):
+    limit_threads(threads)
+    if initializer:
+        initializer(threads, *initargs)
+
+def run_parallel(fn, tasks, jobs: int = 1, threads: int = None, initializer=None, initargs=(), cost=None,
+                 on_result=None):
+    # Calls fn(*task) for each task and returns the results in task order. With
+    # cost (task -> expected run time) tasks start most expensive first, so cheap
+    # fits fill in around the long ones instead of trailing after them.
+    # on_result(task, result) is called in this process as each task finishes.
+    # initializer(threads_per_worker, *initargs) runs once per worker process, so
+    # per-process state (loaded splits, fitted preprocessors) is built once and
+    # reused by every task on that worker. With one worker everything runs
+    # in-process, and thread limits are applied only when a budget is given.
+    workers, per = split_budget(len(tasks), jobs, threads)
+    order = sorted(range(len(tasks)), key=lambda i: -cost(tasks[i])) if cost else range(len(tasks))
+    if workers == 1:
+        if threads:
+            limit_threads(per)
+        if initializer:
+            initializer(per if threads else None, *initargs)
+        results = {}
+        for i in order:
+            results[i] = fn(*tasks[i])
+            if on_result:
+                on_result(tasks[i], results[i])
+        return [results[i] for i in range(len(tasks))]
+    print(f"[scheduler] {len(tasks)} tasks on {workers} workers x {per} threads")
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init, initargs=(per, initializer, initargs)) as ex:
+        futs = {ex.submit(fn, *tasks[i]): i for i in order}
+        results = {}
+        for f in as_completed(futs):
+            i = futs[f]
+            results[i] = f.result()
+            if on_result:
+                on_result(tasks[i], results[i])
+        return [results[i] for i in range(len(tasks))]
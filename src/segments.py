@@ -0,0 +1,170 @@
+import json, numpy as np, pandas as pd
+from .cost_sweep import cost, json_threshold
+
+# Metrics per segment (e.g. PULocationID x hour) in one vectorized pass: rows are
+# sorted once by (segment, descending score) and ROC-AUC, PR-AUC, Brier, ECE and
+# expected cost come from per-segment cumulative counts and bincounts, with no
+# Python loop over segments. Tied scores share one threshold, as in sklearn.
+
+def segment_codes(keys: pd.DataFrame):
+    # -> (segment code per row, one row of key values per segment); columns are
+    # factorized one by one and combined as mixed-radix integers
+    parts = [pd.factorize(keys[c], sort=True, use_na_sentinel=False) for c in keys.columns]
+    shape = tuple(len(u) for _, u in parts)
+    flat = np.ravel_multi_index([c for c, _ in parts], shape)
+    if np.prod(shape, dtype=np.float64) <= 4 * len(flat) + 1024:
+        # dense key space: relabel the used combinations with a counting pass
+        present = np.bincount(flat, minlength=int(np.prod(shape))) > 0
+        used, codes = np.flatnonzero(present), (np.cumsum(present) - 1)[flat]
+    else:
+        used, codes = np.unique(flat, return_inverse=True)
+    idx = np.unravel_index(used, shape)
+    return codes, pd.DataFrame({c: u.take(i) for c, (_, u), i in zip(keys.columns, parts, idx)})
+
+def score_runs(g, y, p, P, N):
+    # Runs of equal (segment, score) in segment-then-descending-score order, one
+    # threshold each -> (segment, score, positives, negatives, positives and
+    # negatives scored at or above the run within its segment) per run
+    order = np.argsort(-p)
+    gk = g.astype(np.uint16) if len(P) <= 1 << 16 else g      # uint16 keys take numpy's radix sort
+    order = order[np.argsort(gk[order], kind="stable")]
+    gs, ps, ys = g[order], p[order], y[order]
+    new = np.r_[True, (gs[1:] != gs[:-1]) | (ps[1:] != ps[:-1])]
+    run = np.cumsum(new) - 1
+    run_g = gs[new]
+    run_pos = np.bincount(run, weights=ys)
+    run_neg = np.bincount(run, weights=1 - ys)
+    tp = np.cumsum(run_pos) - np.r_[0, np.cumsum(P)[:-1]][run_g]
+    fp = np.cumsum(run_neg) - np.r_[0, np.cumsum(N)[:-1]][run_g]
+    return run_g, ps[new], run_pos, run_neg, tp, fp
+
+def segment_metrics(keys: pd.DataFrame, y, p, ccfg=None, threshold=None, n_bins=15, min_rows=1) -> pd.DataFrame:
+    # keys: one column per segment dimension, aligned with y and p. Segments with
+    # one class only get NaN AUCs. threshold: cut for expected_cost (with ccfg).
+    y = np.asarray(y).astype(np.int64)
+    p = np.asarray(p, dtype=np.float64)
+    g, out = segment_codes(keys)
+    G = len(out)
+    n = np.bincount(g, minlength=G)
+    P = np.bincount(g, weights=y, minlength=G)
+    N = n - P
+
+    # by segment, then descending score (stable radix sort of codes over a score sort)
+    run_g, _, run_pos, run_neg, tp, fp = score_runs(g, y, p, P, N)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        out["n"] = n
+        out["n_pos"] = P.astype(np.int64)
+        out["pos_rate"] = P / n
+        out["mean_score"] = np.bincount(g, weights=p, minlength=G) / n
+        # each negative beats the positives above its run, and half of those tied with it
+        out["roc_auc"] = np.bincount(run_g, weights=run_neg * (tp - 0.5 * run_pos), minlength=G) / (P * N)
+        out["pr_auc"] = np.bincount(run_g, weights=run_pos * tp / (tp + fp), minlength=G) / P
+        out["brier"] = np.bincount(g, weights=(p - y) ** 2, minlength=G) / n
+        # ece_score bins per segment: |positives - summed scores| per (segment, bin)
+        b = np.digitize(p, np.linspace(0.0, 1.0, n_bins + 1)) - 1
+        ok = (b >= 0) & (b < n_bins)
+        gap = np.bincount(g[ok] * n_bins + b[ok], weights=(y - p)[ok], minlength=G * n_bins)
+        out["ece"] = np.abs(gap.reshape(G, n_bins)).sum(1) / n
+        if threshold is not None:
+            hit = p >= threshold
+            tp_t = np.bincount(g, weights=hit & (y == 1), minlength=G)
+            fp_t = np.bincount(g, weights=hit & (y == 0), minlength=G)
+            out["expected_cost"] = cost(tp_t, fp_t, P - tp_t, N - fp_t, ccfg)
+            out["cost_per_row"] = out["expected_cost"] / n
+    return out[out["n"] >= min_rows].reset_index(drop=True)
+
+def sliced_metrics(frame: pd.DataFrame, by, y, p, ccfg=None, threshold=None, n_bins=15, min_rows=1) -> pd.DataFrame:
+    # by: list of groupings, e.g. [["PULocationID", "hour"], ["payment_type"]] ->
+    # one long table: `segment` names the grouping, key columns not in it are null
+    parts = [segment_metrics(frame[list(cols)], y, p, ccfg, threshold, n_bins, min_rows)
+             .assign(segment=",".join(cols)) for cols in by]
+    df = pd.concat(parts, ignore_index=True)
+    keys = list(dict.fromkeys(c for cols in by for c in cols))
+    # keys missing from a grouping are null; keep integer keys integer (nullable)
+    df[keys] = df[keys].convert_dtypes(convert_string=False, convert_boolean=False)
+    return df[["segment"] + keys + [c for c in df.columns if c not in keys and c != "segment"]]
+
+# Per-segment cost-optimal thresholds. Total cost is the sum of segment costs, so
+# the joint optimum is each segment's own argmin, found for all segments at once:
+# on the configured grid from one (segment, grid cell) bincount, or exactly over
+# every distinct score from the score runs above. Segments with fewer than
+# min_rows rows keep the global threshold.
+
+def best_cuts(g, G, y, p, ccfg, grid=None):
+    # -> (threshold, cost) per segment; +inf = predict no positives
+    P = np.bincount(g, weights=y, minlength=G)
+    N = np.bincount(g, minlength=G) - P
+    if grid is not None:
+        grid = np.asarray(grid, dtype=np.float64)
+        order = np.argsort(grid, kind="stable")
+        t = grid[order]
+        # rows with k grid values <= p are positive at thresholds t[:k]
+        k = np.searchsorted(t, p, side="right")
+        T = len(t) + 1
+        pos = np.bincount(g * T + k, weights=y, minlength=G * T).reshape(G, T)
+        neg = np.bincount(g * T + k, weights=1 - y, minlength=G * T).reshape(G, T)
+        tp = np.cumsum(pos[:, ::-1], 1)[:, ::-1][:, 1:]
+        fp = np.cumsum(neg[:, ::-1], 1)[:, ::-1][:, 1:]
+        c = cost(tp, fp, P[:, None] - tp, N[:, None] - fp, ccfg)
+        c = c[:, np.argsort(order)]                 # back to config order, so ties pick as evaluate does
+        j = np.argmin(c, 1)
+        return grid[j], c[np.arange(G), j]
+    run_g, score, _, _, tp, fp = score_runs(g, y, p, P, N)
+    c = cost(tp, fp, P[run_g] - tp, N[run_g] - fp, ccfg)
+    first = np.r_[True, run_g[1:] != run_g[:-1]]
+    seg_idx = np.cumsum(first) - 1                   # run -> position of its segment
+    segs = run_g[first]
+    low = np.minimum.reduceat(c, np.flatnonzero(first))
+    # highest score reaching each segment's minimum; predicting none wins ties, as in optimal_threshold
+    hits = np.flatnonzero(c == low[seg_idx])
+    at = hits[np.unique(seg_idx[hits], return_index=True)[1]]
+    th, best = np.full(G, np.inf), cost(0, 0, P, N, ccfg).astype(np.float64)
+    better = low < best[segs]
+    th[segs[better]], best[segs[better]] = score[at][better], low[better]
+    return th, best
+
+class SegmentThresholds:
+    # threshold per segment of `by` columns, default for unseen / small segments
+    def __init__(self, by, table: pd.DataFrame, default: float):
+        self.by, self.table, self.default = list(by), table, float(default)
+
+    @classmethod
+    def fit(cls, keys: pd.DataFrame, y, p, ccfg, grid=None, min_rows=1):
+        y = np.asarray(y).astype(np.float64)
+        p = np.asarray(p, dtype=np.float64)
+        g, table = segment_codes(keys)
+        default = best_cuts(np.zeros(len(p), dtype=np.int64), 1, y, p, ccfg, grid)[0][0]
+        th, c = best_cuts(g, len(table), y, p, ccfg, grid)
+        table["n_valid"] = np.bincount(g, minlength=len(table))
+        small = table["n_valid"].to_numpy() < min_rows
+        table["threshold"] = np.where(small, default, th)
+        table["valid_cost"] = c
+        return cls(keys.columns, table[~small].reset_index(drop=True), default)
+
+    def apply(self, keys: pd.DataFrame) -> np.ndarray:
+        # -> threshold per row of keys
+        th = keys[self.by].merge(self.table[self.by + ["threshold"]], how="left", on=self.by)["threshold"]
+        return th.fillna(self.default).to_numpy()
+
+    def lookup(self, values) -> float:
+        # one request: {column: value}
+        if not hasattr(self, "_index"):
+            self._index = {tuple(r[:-1]): r[-1] for r in self.table[self.by + ["threshold"]].itertuples(index=False)}
+        return self._index.get(tuple(values[c] for c in self.by), self.default)
+
+    def save(self, path: str):
+        rows = [{"key": [v.item() if hasattr(v, "item") else v for v in r[:-2]], "threshold": json_threshold(r[-2]),
+                 "n_valid": int(r[-1])} for r in self.table[self.by + ["threshold", "n_valid"]].itertuples(index=False)]
+        with open(path, "w") as f:
+            json.dump({"segment_by": self.by, "default": json_threshold(self.default), "thresholds": rows}, f, indent=2)
+
+    @classmethod
+    def load(cls, path: str):
+        with open(path, "r") as f:
+            d = json.load(f)
+        # None threshold: predict no positives
+        inf = lambda t: np.inf if t is None else t
+        table = pd.DataFrame([r["key"] + [inf(r["threshold"]), r["n_valid"]] for r in d["thresholds"]],
+                             columns=d["segment_by"] + ["threshold", "n_valid"])
+        return cls(d["segment_by"], table, inf(d["default"]))
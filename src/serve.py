@@ -1,9 +1,12 @@
 from fastapi import FastAPI
 from pydantic import BaseModel
+import os
 import time
 import orjson
 from joblib import load
 import numpy as np
+from .segments import SegmentThresholds
+from .cost_sweep import json_threshold
 
 app = FastAPI(title="Tip20 Classifier")
 
@@ -24,6 +27,8 @@ class Request(BaseModel):
 class Response(BaseModel):
     proba: float
     latency_ms: float
+    threshold: float | None = None
+    decision: int | None = None
 
 MODELS = {}
 
@@ -33,6 +38,15 @@ def get_model(name: str):
         MODELS[name] = load(f"models/seed_42/{name}.joblib")
     return MODELS[name]
 
+THRESHOLDS = {}
+
+def get_thresholds(name: str):
+    # per-segment thresholds exported by `evaluate --segment_thresholds`, if any
+    if name not in THRESHOLDS:
+        path = f"models/seed_42/{name}_thresholds.json"
+        THRESHOLDS[name] = SegmentThresholds.load(path) if os.path.exists(path) else None
+    return THRESHOLDS[name]
+
 @app.post("/predict", response_model=Response)
 def predict(req: Request):
     mdl = get_model(req.model)
@@ -41,4 +55,10 @@ def predict(req: Request):
     start = time.time()
     proba = float(mdl.predict_proba(x)[0,1])
     latency_ms = (time.time() - start) * 1000.0
-    return Response(proba=proba, latency_ms=latency_ms)
+    st = get_thresholds(req.model)
+    if st is None:
+        return Response(proba=proba, latency_ms=latency_ms)
+    threshold = st.lookup(req.model_dump())
+    # an infinite threshold (predict no positives) is reported as null
+    return Response(proba=proba, latency_ms=latency_ms, threshold=json_threshold(threshold),
+                    decision=int(proba >= threshold))
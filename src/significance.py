@@ -0,0 +1,187 @@
+import os, math, argparse, itertools, numpy as np, pandas as pd
+from sklearn.metrics import average_precision_score
+from .evaluate import load_config
+from .models import model_roster, stack_predictions
+from .prediction_store import PredictionStore
+from .cost_sweep import threshold_costs, cost
+from .bootstrap import bin_index, draw_counts, pr_auc_counts
+from .scheduler import run_parallel
+
+# Paired tests between models scored on the same test rows, from the prediction
+# store. ROC-AUC: DeLong's test in the O(n log n) midrank form of Sun & Xu
+# (2014); each model's structural components are computed once per seed and any
+# pair then costs O(n). PR-AUC and expected cost: paired bootstrap over joint
+# cells (score-quantile bin of model a, of model b, label), so both models see
+# the same resample and a replicate costs O(cells), as in src/bootstrap.py.
+# Observed deltas are exact; replicates are shifted by the binning error of the
+# observed delta.
+
+_P = {}
+MAX_DRAW = 1 << 24     # cells x replicates per draw
+
+def midrank(x):
+    # 1-based ranks with ties at their average rank
+    order = np.argsort(x, kind="mergesort")
+    xs = x[order]
+    starts = np.r_[0, np.flatnonzero(xs[1:] != xs[:-1]) + 1]
+    ends = np.r_[starts[1:], len(xs)]
+    out = np.empty(len(x))
+    out[order] = np.repeat((starts + ends + 1) / 2.0, ends - starts)
+    return out
+
+def delong_components(y, p):
+    # -> (auc, v10 over positives, v01 over negatives)
+    y = np.asarray(y).astype(bool)
+    pos, neg = p[y], p[~y]
+    m, n = len(pos), len(neg)
+    tz = midrank(np.r_[pos, neg])
+    tx, ty = midrank(pos), midrank(neg)
+    auc = tz[:m].sum() / (m * n) - (m + 1) / (2.0 * n)
+    return auc, (tz[:m] - tx) / n, 1.0 - (tz[m:] - ty) / m
+
+def delong_test(a, b):
+    # components of two models on the same rows -> (delta auc, z, two-sided p)
+    (auc_a, v10a, v01a), (auc_b, v10b, v01b) = a, b
+    var = np.cov(np.vstack([v10a, v10b])) / len(v10a) + np.cov(np.vstack([v01a, v01b])) / len(v01a)
+    se = math.sqrt(max(var[0, 0] + var[1, 1] - 2 * var[0, 1], 0.0))
+    delta = auc_a - auc_b
+    z = delta / se if se > 0 else (0.0 if delta == 0 else math.copysign(math.inf, delta))
+    return delta, z, math.erfc(abs(z) / math.sqrt(2))
+
+class PairedCells:
+    # rows of two models grouped by (bin a, bin b, label); bins are score quantiles
+    # plus the cost threshold as an edge, so replicate costs are exact
+    def __init__(self, y, pa, pb, ta, tb, resolution=256):
+        y = np.asarray(y).astype(np.int64)
+        q = np.linspace(0.0, 1.0, resolution + 1)
+        ea, eb = np.unique(np.r_[np.quantile(pa, q), ta]), np.unique(np.r_[np.quantile(pb, q), tb])
+        ia, ib = bin_index(ea, pa), bin_index(eb, pb)
+        cell, self.n = np.unique((ia * len(eb) + ib) * 2 + y, return_counts=True)
+        self.label = (cell % 2).astype(bool)
+        self.bins = {"a": (cell // 2) // len(eb), "b": (cell // 2) % len(eb)}
+        self.hit = {"a": ea[self.bins["a"]] >= ta, "b": eb[self.bins["b"]] >= tb}
+        # per model: cell order by bin and group starts, to sum replicate counts per bin
+        self.groups = {}
+        for k, bins in self.bins.items():
+            order = np.argsort(bins, kind="stable")
+            starts = np.r_[0, np.flatnonzero(np.diff(bins[order])) + 1]
+            self.groups[k] = (order, starts)
+
+    def marginal(self, counts, k):
+        # (replicates, cells) -> positives, negatives per ascending bin of model k
+        order, starts = self.groups[k]
+        c, lab = counts[:, order], self.label[order]
+        return (np.add.reduceat(np.where(lab, c, 0.0), starts, axis=1),
+                np.add.reduceat(np.where(lab, 0.0, c), starts, axis=1))
+
+    def deltas(self, counts, ccfg):
+        # metric of model a minus model b per replicate
+        P, N = (counts * self.label).sum(1), (counts * ~self.label).sum(1)
+        pr, ec = {}, {}
+        for k in ("a", "b"):
+            pr[k] = pr_auc_counts(*self.marginal(counts, k))
+            tp = (counts * (self.hit[k] & self.label)).sum(1)
+            fp = (counts * (self.hit[k] & ~self.label)).sum(1)
+            ec[k] = cost(tp, fp, P - tp, N - fp, ccfg)
+        return {"pr_auc": pr["a"] - pr["b"], "expected_cost": ec["a"] - ec["b"]}
+
+def _paired_replicates(cells: PairedCells, seed_seq, n, method, ccfg):
+    counts = draw_counts(np.random.default_rng(seed_seq), cells.n.astype(np.float64), n, method)
+    return cells.deltas(counts, ccfg)
+
+def paired_bootstrap(y, pa, pb, ta, tb, ccfg, n_boot=1000, seed=0, method="multinomial", resolution=256):
+    # -> ({metric: observed delta a - b}, {metric: (n_boot,) replicate deltas})
+    cells = PairedCells(y, pa, pb, ta, tb, resolution)
+    binned = {k: float(v[0]) for k, v in cells.deltas(cells.n[None].astype(np.float64), ccfg).items()}
+    observed = {"pr_auc": float(average_precision_score(y, pa) - average_precision_score(y, pb)),
+                "expected_cost": float(threshold_costs(y, pa, [ta], ccfg)[0] - threshold_costs(y, pb, [tb], ccfg)[0])}
+    block = max(1, min(64, MAX_DRAW // len(cells.n)))
+    sizes = [min(block, n_boot - i) for i in range(0, n_boot, block)]
+    seqs = np.random.SeedSequence(seed).spawn(len(sizes))
+    parts = [_paired_replicates(cells, s, k, method, ccfg) for s, k in zip(seqs, sizes)]
+    return observed, {k: np.concatenate([r[k] for r in parts]) + observed[k] - binned[k] for k in parts[0]}
+
+def init_scores(threads, cfg, seeds, names, filters):
+    # test scores, labels, best grid thresholds and DeLong components per (seed, model)
+    if "scores" in _P:
+        return
+    dcfg, ccfg = cfg["data"], cfg["costs"]
+    store = PredictionStore(dcfg.get("prediction_store_dir") or "data/predictions", dcfg["processed_dir"],
+                            dcfg["label_col"], dcfg.get("id_col"), dcfg.get("feature_cache_dir"))
+    _, members = model_roster(cfg)
+    # stack members are scored even when not compared themselves
+    base = list(dict.fromkeys([n for n in names if n != "stack"] + (members if "stack" in names else [])))
+    scores, labels = {}, {}
+    for seed in seeds:
+        for name in base:
+            sc = store.scores(f"models/seed_{seed}/{name}.joblib", seed, dcfg["test_months"], filters)
+            scores[(seed, name)] = sc["score"].to_numpy()
+            labels[seed] = sc["label"].to_numpy().astype(int)
+        if "stack" in names:
+            scores[(seed, "stack")] = stack_predictions(np.vstack([scores[(seed, n)] for n in members]))
+    thresholds = {}
+    for (seed, name), p in scores.items():
+        ecs = threshold_costs(labels[seed], p, ccfg["thresholds"], ccfg)
+        thresholds[(seed, name)] = float(ccfg["thresholds"][int(np.argmin(ecs))])
+    delong = {k: delong_components(labels[k[0]], p) for k, p in scores.items()}
+    _P.update(cfg=cfg, scores=scores, labels=labels, thresholds=thresholds, delong=delong)
+
+def compare(seed, a, b, n_boot, boot_seed, method, alpha):
+    ka, kb = (seed, a), (seed, b)
+    row = {"seed": seed, "model_a": a, "model_b": b, "n_test": len(_P["labels"][seed])}
+    d, z, p = delong_test(_P["delong"][ka], _P["delong"][kb])
+    row.update(roc_auc_a=float(_P["delong"][ka][0]), roc_auc_b=float(_P["delong"][kb][0]),
+               delta_roc_auc=float(d), z_delong=float(z), p_delong=p)
+    observed, reps = paired_bootstrap(_P["labels"][seed], _P["scores"][ka], _P["scores"][kb], _P["thresholds"][ka],
+                                      _P["thresholds"][kb], _P["cfg"]["costs"], n_boot, boot_seed, method)
+    for k, r in reps.items():
+        lo, hi = np.nanquantile(r, [alpha / 2, 1 - alpha / 2])
+        # two-sided: how often the resampled delta lands on either side of zero, as
+        # (1 + count) / (n + 1) so it is never below 1 / (n_boot + 1)
+        pval = min(1.0, 2 * (1 + min(np.sum(r <= 0), np.sum(r >= 0))) / (len(r) + 1))
+        row.update({f"delta_{k}": observed[k], f"{k}_ci_lo": float(lo), f"{k}_ci_hi": float(hi), f"p_{k}": float(pval)})
+    return row
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--cfg", type=str, required=True)
+    ap.add_argument("--seeds", type=int, nargs="+", default=[42,43,44])
+    ap.add_argument("--models", type=str, nargs="+", default=None, help="default: the training.models roster")
+    ap.add_argument("--filter", nargs=3, action="append", default=[], metavar=("COL","OP","VALUE"))
+    ap.add_argument("--slice_name", type=str, default="")
+    ap.add_argument("--n_boot", type=int, default=1000)
+    ap.add_argument("--boot_seed", type=int, default=0)
+    ap.add_argument("--boot_method", type=str, default="multinomial", choices=["multinomial","poisson"])
+    ap.add_argument("--alpha", type=float, default=0.05)
+    ap.add_argument("--jobs", type=int, default=1, help="processes over (seed, model pair) tests")
+    args = ap.parse_args()
+
+    cfg = load_config(args.cfg)
+    names, members = model_roster(cfg)
+    roster = names + (["stack"] if members else [])
+    unknown = [n for n in args.models or [] if n not in roster]
+    if unknown:
+        raise ValueError(f"--models not in the training.models roster {roster}: {unknown}")
+    names = args.models or roster
+    filters = (cfg["data"].get("filters") or []) + args.filter
+    # loaded here so forked workers share the scores
+    init_scores(None, cfg, args.seeds, names, filters)
+    tasks = [(seed, a, b, args.n_boot, args.boot_seed, args.boot_method, args.alpha)
+             for seed in args.seeds for a, b in itertools.combinations(names, 2)]
+    rows = run_parallel(compare, tasks, jobs=args.jobs, initializer=init_scores,
+                        initargs=(cfg, args.seeds, names, filters))
+
+    sfx = f"_{args.slice_name}" if args.slice_name else ""
+    os.makedirs("reports/significance", exist_ok=True)
+    df = pd.DataFrame(rows)
+    df.to_csv(f"reports/significance/pairs{sfx}.csv", index=False)
+    # per pair over seeds: mean delta, and the largest p (a difference that holds on every seed)
+    p_cols = [c for c in df.columns if c.startswith("p_")]
+    summ = df.groupby(["model_a", "model_b"], sort=False).agg(
+        n_seeds=("seed", "size"), **{f"{c}_mean": (c, "mean") for c in df.columns if c.startswith("delta_")},
+        **{f"{c}_max": (c, "max") for c in p_cols}).reset_index()
+    summ.to_csv(f"reports/significance/pairs_summary{sfx}.csv", index=False)
+    print(summ.to_string(index=False))
+
+if __name__ == "__main__":
+    main()
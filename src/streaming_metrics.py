@@ -0,0 +1,109 @@
+import numpy as np
+from .bootstrap import roc_auc_counts, pr_auc_counts
+from .cost_sweep import cost
+
+# Mergeable metric state for scoring test months batch by batch. Memory is the
+# size of the histograms, not the row count, and accumulators from different
+# batches, processes or months add up exactly (merge). ROC/PR-AUC come from a
+# fine score histogram (rows in one bin count as tied; auc_tie_bound is the most
+# ROC-AUC can move from that); Brier, log-loss, threshold costs and calibration
+# counts are exact.
+
+EPS = 1e-15       # log-loss clipping
+
+class MetricAccumulator:
+    def __init__(self, thresholds=(), n_bins: int = 15, resolution: int = 1 << 16):
+        self.thresholds = np.asarray(thresholds, dtype=np.float64)
+        self.n_bins, self.resolution = n_bins, resolution
+        self.pos = np.zeros(resolution + 1, dtype=np.int64)     # last bin: p == 1.0
+        self.neg = np.zeros(resolution + 1, dtype=np.int64)
+        self.tp = np.zeros(len(self.thresholds), dtype=np.int64)  # rows with p >= threshold
+        self.fp = np.zeros(len(self.thresholds), dtype=np.int64)
+        self.cal_n = np.zeros(n_bins, dtype=np.int64)           # ece_score bins
+        self.cal_y = np.zeros(n_bins, dtype=np.float64)
+        self.cal_p = np.zeros(n_bins, dtype=np.float64)
+        self.n, self.sq_err, self.log_loss = 0, 0.0, 0.0
+
+    def update(self, y, p):
+        y = np.asarray(y).astype(bool)
+        p = np.asarray(p, dtype=np.float64)
+        b = np.clip((p * self.resolution).astype(np.int64), 0, self.resolution)
+        self.pos += np.bincount(b[y], minlength=self.resolution + 1)
+        self.neg += np.bincount(b[~y], minlength=self.resolution + 1)
+        if len(self.thresholds):
+            hit = p[:, None] >= self.thresholds
+            self.tp += (hit & y[:, None]).sum(0)
+            self.fp += (hit & ~y[:, None]).sum(0)
+        c = np.digitize(p, np.linspace(0.0, 1.0, self.n_bins + 1)) - 1
+        ok = (c >= 0) & (c < self.n_bins)
+        self.cal_n += np.bincount(c[ok], minlength=self.n_bins)
+        self.cal_y += np.bincount(c[ok], weights=y[ok], minlength=self.n_bins)
+        self.cal_p += np.bincount(c[ok], weights=p[ok], minlength=self.n_bins)
+        self.n += len(p)
+        self.sq_err += float(((p - y) ** 2).sum())
+        q = np.clip(p, EPS, 1 - EPS)
+        self.log_loss -= float(np.where(y, np.log(q), np.log1p(-q)).sum())
+        return self
+
+    def merge(self, other: "MetricAccumulator"):
+        if (other.resolution, other.n_bins) != (self.resolution, self.n_bins) or \
+                not np.array_equal(other.thresholds, self.thresholds):
+            raise ValueError("cannot merge accumulators with different bins or thresholds")
+        for k in ("pos", "neg", "tp", "fp", "cal_n", "cal_y", "cal_p"):
+            getattr(self, k).__iadd__(getattr(other, k))
+        self.n += other.n
+        self.sq_err += other.sq_err
+        self.log_loss += other.log_loss
+        return self
+
+    def costs(self, ccfg):
+        # expected cost at each threshold
+        P = int(self.pos.sum())
+        return cost(self.tp, self.fp, P - self.tp, self.n - P - self.fp, ccfg)
+
+    def result(self, ccfg) -> dict:
+        pos, neg = self.pos.astype(np.float64), self.neg.astype(np.float64)
+        P, N = pos.sum(), neg.sum()
+        out = {
+            "n": int(self.n),
+            "roc_auc": float(roc_auc_counts(pos, neg)),
+            "pr_auc": float(pr_auc_counts(pos, neg)),
+            "brier": self.sq_err / self.n,
+            "log_loss": self.log_loss / self.n,
+            "ece": float(np.abs(self.cal_y - self.cal_p).sum() / self.n),
+            "auc_tie_bound": float(0.5 * (pos * neg).sum() / (P * N)),
+        }
+        if len(self.thresholds):
+            ecs = self.costs(ccfg)
+            i = int(np.argmin(ecs))
+            out.update(best_threshold=float(self.thresholds[i]), min_expected_cost=float(ecs[i]))
+        # cost-optimal cut over histogram edges ("predict 1 if p >= edge"); the
+        # exact optimum lies within one bin of it
+        tp = np.r_[np.cumsum(pos[::-1])[::-1], 0.0]
+        fp = np.r_[np.cumsum(neg[::-1])[::-1], 0.0]
+        c = cost(tp, fp, P - tp, N - fp, ccfg)
+        i = int(np.argmin(c))
+        # None: predicting no positives is cheapest
+        out.update(opt_threshold=float(i / self.resolution) if i <= self.resolution else None,
+                   opt_expected_cost=float(c[i]))
+        return out
+
+    def calibration(self):
+        # -> (fraction of positives, mean score) per non-empty ece bin
+        ok = self.cal_n > 0
+        return self.cal_y[ok] / self.cal_n[ok], self.cal_p[ok] / self.cal_n[ok]
+
+    def save(self, path: str):
+        np.savez(path, thresholds=self.thresholds, pos=self.pos, neg=self.neg, tp=self.tp, fp=self.fp,
+                 cal_n=self.cal_n, cal_y=self.cal_y, cal_p=self.cal_p,
+                 sums=np.array([self.n, self.sq_err, self.log_loss], dtype=np.float64))
+
+    @classmethod
+    def load(cls, path: str):
+        z = np.load(path)
+        acc = cls(z["thresholds"], len(z["cal_n"]), len(z["pos"]) - 1)
+        for k in ("pos", "neg", "tp", "fp", "cal_n", "cal_y", "cal_p"):
+            setattr(acc, k, z[k])
+        n, acc.sq_err, acc.log_loss = z["sums"]
+        acc.n = int(n)
+        return acc
@@ -1,74 +1,227 @@
 import os, json, glob, numpy as np, pandas as pd, yaml, argparse
 from sklearn.metrics import roc_auc_score, average_precision_score, brier_score_loss
 from joblib import dump
-from .models import make_logreg, make_xgb, make_catboost
+from sklearn.pipeline import Pipeline
+from xgboost import XGBClassifier
+from catboost import CatBoostClassifier
+from .models import make_logreg, make_xgb, make_catboost, model_roster, stack_predictions, EXPECTED_COST
+from .preprocess import read_processed
+from .feature_cache import FeatureCache
+from .dataset_cache import QuantizedCache, fit_estimator, best_iteration
+from .external_memory import ExternalTrainer, month_files, schema_frame, predict_files
+from .scheduler import run_parallel, set_estimator_threads
 
 def load_config(path: str):
     with open(path, "r") as f:
         return yaml.safe_load(f)
 
-def load_splits(processed_dir, months, label_col):
+def load_splits(processed_dir, months, label_col, columns=None, filters=None, cache_dir=None):
+    # columns: features to read (label is always added); filters: [[col, op, value], ...]
+    # cache_dir: serve months from the shared mmap FeatureCache instead of parquet
+    if cache_dir:
+        return FeatureCache(cache_dir, processed_dir, label_col).load_splits(months, columns, filters)
+    if columns is not None and label_col not in columns:
+        columns = list(columns) + [label_col]
     frames = []
     for m in months:
         fp = os.path.join(processed_dir, f"table_{m}.parquet")
         if not os.path.exists(fp):
             raise FileNotFoundError(fp)
-        frames.append(pd.read_parquet(fp))
+        frames.append(read_processed(fp, columns=columns, filters=filters))
     df = pd.concat(frames, ignore_index=True)
     X = df.drop(columns=[label_col])
     y = df[label_col].astype(int).values
     return X, y
 
-def infer_feature_types(df: pd.DataFrame, label_col: str, time_col: str):
+def infer_feature_types(df: pd.DataFrame, label_col: str, time_col: str, categorical=()):
+    # categorical: numeric-coded columns to treat as categorical (features.categorical)
     cols = [c for c in df.columns if c not in [label_col, time_col]]
-    num_cols = [c for c in cols if str(df[c].dtype).startswith(("float","int"))]
+    num_cols = [c for c in cols if str(df[c].dtype).lower().startswith(("float","int","uint")) and c not in categorical]
     cat_cols = [c for c in cols if c not in num_cols]
     return num_cols, cat_cols
 
+def binary_metrics(y, p):
+    return {
+        "roc_auc": float(roc_auc_score(y, p)),
+        "pr_auc": float(average_precision_score(y, p)),
+        "brier": float(brier_score_loss(y, p))
+    }
+
+def train_external(cfg, seeds, batch_rows):
+    # Out-of-core XGBoost: train/valid months are streamed from parquet in record
+    # batches (see external_memory.py); always uses the tree-native feature path.
+    # training.early_stopping_rounds / checkpoint_every apply as in fit_model.
+    dcfg, mcfg, tcfg = cfg["data"], cfg["models"], cfg.get("training", {})
+    names, _ = model_roster(cfg)
+    if names != ["xgb"]:
+        raise ValueError(f"--external_memory trains xgb only; set training.models to [xgb] (got {names})")
+    filters = dcfg.get("filters")
+    files = month_files(dcfg["processed_dir"], dcfg["train_months"])
+    va_files = month_files(dcfg["processed_dir"], dcfg["valid_months"])
+    num_cols, cat_cols = infer_feature_types(schema_frame(files[0]), dcfg["label_col"], dcfg["time_col"],
+                                             cfg.get("features", {}).get("categorical") or ())
+    trainer = ExternalTrainer(files, dcfg["label_col"], num_cols, cat_cols,
+                              mcfg["xgboost"].get("max_bin") or 256, batch_rows, filters=filters,
+                              valid_files=va_files if tcfg.get("early_stopping_rounds") else None)
+    try:
+        for seed in seeds:
+            seed_dir = f"models/seed_{seed}"
+            os.makedirs(seed_dir, exist_ok=True)
+            print(f"[seed {seed}] Fitting xgb (external memory)...")
+            ckpt = os.path.join(seed_dir, "ckpt_xgb") if tcfg.get("checkpoint_every") else None
+            mdl = trainer.fit(mcfg["xgboost"], seed, tcfg.get("early_stopping_rounds"), ckpt,
+                              tcfg.get("checkpoint_every") or 50)
+            p_va, yva = predict_files(mdl, va_files, dcfg["label_col"], batch_rows, filters)
+            dump(mdl, os.path.join(seed_dir, "xgb.joblib"))
+            np.save(os.path.join(seed_dir, "xgb_valid.npy"), p_va)
+            metrics = binary_metrics(yva, p_va)
+            if tcfg.get("early_stopping_rounds"):
+                metrics["best_iteration"] = best_iteration(mdl[-1])
+            with open(f"reports/metrics/valid_seed_{seed}.json", "w") as f:
+                json.dump({"xgb": metrics}, f, indent=2)
+            print(f"[seed {seed}] Done. Metrics saved.")
+    finally:
+        trainer.close()
+
+def model_factories(cfg):
+    # name -> factory(num_cols, cat_cols) returning an unfitted Pipeline
+    mcfg, tcfg = cfg["models"], cfg["training"]
+    native = tcfg.get("tree_native", False)
+    return {
+      "logreg": lambda num, cat: make_logreg(num, cat, C=mcfg["logistic_regression"]["C"], max_iter=mcfg["logistic_regression"]["max_iter"]),
+      "xgb": lambda num, cat: make_xgb(num, cat, mcfg["xgboost"], native=native),
+      "cat": lambda num, cat: make_catboost(num, cat, mcfg["catboost"], native=native)
+  }
+
+# training state: splits and feature types loaded once by load_state in the parent
+# (forked workers share them copy-on-write), plus per-worker caches from init_state
+_S = {}
+
+def load_state(cfg):
+    if "Xtr" in _S:
+        return
+    dcfg = cfg["data"]
+    # load train/valid explicitly by months
+    Xtr, ytr = load_splits(dcfg["processed_dir"], dcfg["train_months"], dcfg["label_col"],
+                           filters=dcfg.get("filters"), cache_dir=dcfg.get("feature_cache_dir"))
+    Xva, yva = load_splits(dcfg["processed_dir"], dcfg["valid_months"], dcfg["label_col"],
+                           filters=dcfg.get("filters"), cache_dir=dcfg.get("feature_cache_dir"))
+    num_cols, cat_cols = infer_feature_types(Xtr, dcfg["label_col"], dcfg["time_col"],
+                                             cfg.get("features", {}).get("categorical") or ())
+    _S.update(Xtr=Xtr, ytr=ytr, Xva=Xva, yva=yva, num_cols=num_cols, cat_cols=cat_cols)
+
+def init_state(threads, cfg, reuse_preprocessor=False, quantize=False, quantized_dir=None):
+    load_state(cfg)     # no-op in forked workers
+    dcfg = cfg["data"]
+    cache = None
+    if dcfg.get("feature_cache_dir") and not dcfg.get("filters"):
+        cache = FeatureCache(dcfg["feature_cache_dir"], dcfg["processed_dir"], dcfg["label_col"])
+    _S.update(cfg=cfg, threads=threads, cache=cache, reuse=reuse_preprocessor or quantize,
+              # --reuse_preprocessor: name -> (fitted preprocessor steps, transformed train, transformed valid)
+              shared={},
+              qcache=QuantizedCache(quantized_dir) if quantize else None)
+
+def fit_model(seed, name):
+    # Fits one (seed, model) on the state from init_state, dumps it and returns its valid metrics.
+    S = _S
+    cfg, dcfg = S["cfg"], S["cfg"]["data"]
+    Xtr, ytr, Xva, yva = S["Xtr"], S["ytr"], S["Xva"], S["yva"]
+    seed_dir = f"models/seed_{seed}"
+    os.makedirs(seed_dir, exist_ok=True)
+
+    mdl = model_factories(cfg)[name](S["num_cols"], S["cat_cols"])
+    print(f"[seed {seed}] Fitting {name}...")
+    # set random_state if available
+    if hasattr(mdl[-1], "random_state"):
+        mdl[-1].set_params(random_state=seed)
+    set_estimator_threads(mdl[-1], S["threads"])
+    # early stopping on the valid months / checkpoint-resume (boosters only)
+    tcfg = cfg["training"]
+    fit_kw = {}
+    if isinstance(mdl[-1], (XGBClassifier, CatBoostClassifier)):
+        if tcfg.get("early_stopping_rounds"):
+            fit_kw["early_stopping_rounds"] = tcfg["early_stopping_rounds"]
+        if tcfg.get("checkpoint_every"):
+            fit_kw.update(checkpoint_dir=os.path.join(seed_dir, f"ckpt_{name}"), checkpoint_every=tcfg["checkpoint_every"],
+                          checkpoint_secs=tcfg.get("checkpoint_secs", 600))
+    if S["reuse"] or fit_kw:
+        if name in S["shared"]:
+            steps, Ztr, Zva = S["shared"][name]
+        else:
+            pre = mdl[:-1].fit(Xtr, ytr)
+            if S["cache"]:
+                Ztr, Zva = S["cache"].transform(pre, dcfg["train_months"]), S["cache"].transform(pre, dcfg["valid_months"])
+            else:
+                Ztr, Zva = pre.transform(Xtr), pre.transform(Xva)
+            steps = pre.steps
+            if S["reuse"]:
+                S["shared"][name] = (steps, Ztr, Zva)
+        fit_estimator(mdl[-1], Ztr, ytr, Zva, yva, cache=S["qcache"], key=(name, tuple(dcfg["train_months"])), **fit_kw)
+        p_va = mdl[-1].predict_proba(Zva)[:,1]
+        # complete pipeline (shared fitted preprocessor + this seed's estimator) for serve.py
+        mdl = Pipeline(steps + [mdl.steps[-1]])
+    else:
+        mdl.fit(Xtr, ytr)
+        p_va = mdl.predict_proba(Xva)[:,1]
+
+    dump(mdl, os.path.join(seed_dir, f"{name}.joblib"))
+    # valid scores are kept next to the model so the stack is built without re-predicting
+    np.save(os.path.join(seed_dir, f"{name}_valid.npy"), p_va)
+    metrics = binary_metrics(yva, p_va)
+    if fit_kw.get("early_stopping_rounds"):
+        # predict_proba uses this round (XGBoost best_iteration / CatBoost best model)
+        metrics["best_iteration"] = best_iteration(mdl[-1])
+    return metrics
+
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--cfg", type=str, required=True)
     ap.add_argument("--seeds", type=int, nargs="+", default=[42,43,44])
+    ap.add_argument("--reuse_preprocessor", action="store_true",
+                    help="fit each model's preprocessor once and only refit the estimator per seed")
+    ap.add_argument("--quantize", action="store_true",
+                    help="build XGBoost QuantileDMatrix / CatBoost quantized Pool once and reuse across seeds (implies --reuse_preprocessor)")
+    ap.add_argument("--quantized_dir", type=str, default=None, help="persist quantized CatBoost pools here")
+    ap.add_argument("--external_memory", action="store_true",
+                    help="train XGBoost out-of-core, streaming train months through an on-disk page cache")
+    ap.add_argument("--batch_rows", type=int, default=1_000_000, help="rows per streamed batch with --external_memory")
+    ap.add_argument("--jobs", type=int, default=1, help="(seed, model) fits run concurrently; -1 = one per core")
+    ap.add_argument("--threads", type=int, default=None,
+                    help="total core budget split between the --jobs workers (default: all available cores)")
     args = ap.parse_args()
 
     cfg = load_config(args.cfg)
     dcfg = cfg["data"]
-    tcfg = cfg["training"]
-    mcfg = cfg["models"]
 
     os.makedirs("models", exist_ok=True)
     os.makedirs("reports/metrics", exist_ok=True)
 
-    # load train/valid explicitly by months
-    Xtr, ytr = load_splits(dcfg["processed_dir"], dcfg["train_months"], dcfg["label_col"])
-    Xva, yva = load_splits(dcfg["processed_dir"], dcfg["valid_months"], dcfg["label_col"])
+    if args.external_memory:
+        return train_external(cfg, args.seeds, args.batch_rows)
 
-    num_cols, cat_cols = infer_feature_types(Xtr, dcfg["label_col"], dcfg["time_col"])
+    names, members = model_roster(cfg)
+    factories = model_factories(cfg)
+    unknown = [n for n in names if n not in factories]
+    if unknown:
+        raise ValueError(f"unknown models in training.models: {unknown}")
+    model_cost = {**EXPECTED_COST, **(cfg["training"].get("model_cost") or {})}
+    tasks = [(seed, name) for seed in args.seeds for name in names]
+    # loaded here so forked workers share the splits instead of each reading them
+    load_state(cfg)
+    results = run_parallel(fit_model, tasks, jobs=args.jobs, threads=args.threads, initializer=init_state,
+                           initargs=(cfg, args.reuse_preprocessor, args.quantize, args.quantized_dir),
+                           cost=lambda t: model_cost.get(t[1], 1.0))
 
+    yva = None
     for seed in args.seeds:
-        seed_dir = f"models/seed_{seed}"
-        os.makedirs(seed_dir, exist_ok=True)
-
-        models = {
-      "xgb": make_xgb(num_cols, cat_cols, mcfg["xgboost"])
-  }
-
-        metrics = {}
-        for name, mdl in models.items():
-            print(f"[seed {seed}] Fitting {name}...")
-            # set random_state if available
-            if hasattr(mdl[-1], "random_state"):
-                mdl[-1].set_params(random_state=seed)
-            mdl.fit(Xtr, ytr)
-            p_va = mdl.predict_proba(Xva)[:,1]
-
-            metrics[name] = {
-                "roc_auc": float(roc_auc_score(yva, p_va)),
-                "pr_auc": float(average_precision_score(yva, p_va)),
-                "brier": float(brier_score_loss(yva, p_va))
-            }
-            dump(mdl, os.path.join(seed_dir, f"{name}.joblib"))
-
+        metrics = {name: m for (s, name), m in zip(tasks, results) if s == seed}
+        if members:
+            if yva is None:
+                _, yva = load_splits(dcfg["processed_dir"], dcfg["valid_months"], dcfg["label_col"],
+                                     columns=[], filters=dcfg.get("filters"), cache_dir=dcfg.get("feature_cache_dir"))
+            seed_dir = f"models/seed_{seed}"
+            preds = np.vstack([np.load(os.path.join(seed_dir, f"{n}_valid.npy")) for n in members])
+            metrics["stack"] = binary_metrics(yva, stack_predictions(preds))
         with open(f"reports/metrics/valid_seed_{seed}.json", "w") as f:
             json.dump(metrics, f, indent=2)
 